@@ -1,31 +1,115 @@
+import argparse
 import boto3
+import fnmatch
+import gzip
 import json
 import math
+import os
+import queue
+import threading
+import time
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from botocore.awsrequest import AWSResponse
 from botocore.config import Config
 
 singletons = []
+clients = threading.local()
+cassette = None
 
-def get_resources(tag_name, tag_values, config):
-    """Get resources from resource groups and tagging API.
-    Assembles resources in a list containing only ARN and tags
+def discover_resource_pages(tag_name, tag_values, config, resource_types=None):
+    """Yields pages of tagged resources as they come back from the tagging and autoscaling APIs
+    so that decoration can start before pagination has finished.
+    When resource_types is set only those router resource types are requested.
     """
-    resourcetaggingapi = boto3.client('resourcegroupstaggingapi', config=config)
-    resources = []
-
-    tags = len(tag_values)
-    if tags > 5:
-        tags_processed = 0
-        while tags_processed < tags:
-            incremental_tag_values = tag_values[tags_processed:tags_processed+5]
-            resources = get_resources_from_api(resourcetaggingapi, resources, tag_name, incremental_tag_values)
-            tags_processed += 5
-    else:
-        resources = get_resources_from_api(resourcetaggingapi, resources, tag_name, tag_values)
-    resources.extend(autoscaling_retriever(tag_name, tag_values, config))
-    return resources
+    type_filters = []
+    if resource_types is not None:
+        type_filters = sorted({TAGGING_RESOURCE_TYPES[name] for name in resource_types} - {None})
+    if resource_types is None or type_filters:
+        resourcetaggingapi = get_client('resourcegroupstaggingapi', config=config)
+        expanded_tag_values = expand_tag_values(resourcetaggingapi, tag_name, tag_values)
+        if expanded_tag_values is not None:
+            for incremental_tag_values in chunk_tag_values(expanded_tag_values):
+                yield from get_resource_pages_from_api(resourcetaggingapi, tag_name, incremental_tag_values, type_filters)
+    if resource_types is None or 'autoscaling' in resource_types:
+        if has_tag_patterns(tag_values):
+            for page in get_asg_pages_from_api(tag_name, [], config):
+                yield [resource for resource in page if has_tag(resource, tag_name, tag_values)]
+        else:
+            for incremental_tag_values in chunk_tag_values(tag_values):
+                yield from get_asg_pages_from_api(tag_name, incremental_tag_values, config)
+
+
+def has_tag_patterns(tag_values):
+    return any(char in value for value in tag_values for char in '*?[')
+
+
+def tag_value_matches(value, tag_values):
+    """Tag values are matched as glob patterns, e.g. 2022* or release-202?, an empty list matches every value"""
+    return not tag_values or any(fnmatch.fnmatchcase(value, pattern) for pattern in tag_values)
+
+
+def expand_tag_values(resourcetaggingapi, tag_name, tag_values):
+    """Resolves glob patterns in tag_values against the values of tag_name in the region with one tag values scan.
+    Returns the tag values to filter on: [] when every value of the key matches so that one key-only pass is enough,
+    None when nothing in the region matches.
+    """
+    if not has_tag_patterns(tag_values):
+        return tag_values
+    values = []
+    for response in resourcetaggingapi.get_paginator('get_tag_values').paginate(Key=tag_name):
+        values.extend(response['TagValues'])
+    matching_values = [value for value in values if tag_value_matches(value, tag_values)]
+    print(f'Tag values {tag_values} match {len(matching_values)} of {len(values)} values of {tag_name}')
+    if not matching_values:
+        return None
+    if len(matching_values) == len(values):
+        return []
+    return matching_values
+
+
+def discover_arn_pages(arns, tag_name, tag_values, config):
+    """Yields the given resources that still carry the configured tag"""
+    asg_names = [arn.split('autoScalingGroupName/')[-1] for arn in arns if resource_type(arn) == 'autoscaling']
+    arns = [arn for arn in arns if resource_type(arn) != 'autoscaling']
+    resourcetaggingapi = get_client('resourcegroupstaggingapi', config=config)
+    for offset in range(0, len(arns), 100):
+        response = resourcetaggingapi.get_resources(
+            ResourceARNList=arns[offset:offset+100]
+        )
+        yield [resource for resource in response['ResourceTagMappingList'] if has_tag(resource, tag_name, tag_values)]
+    asg = get_client('autoscaling', config=config)
+    for offset in range(0, len(asg_names), 50):
+        response = asg.describe_auto_scaling_groups(
+            AutoScalingGroupNames=asg_names[offset:offset+50]
+        )
+        yield [resource for resource in asg_page(response) if has_tag(resource, tag_name, tag_values)]
+
+
+def has_tag(resource, tag_name, tag_values):
+    for tag in resource.get('Tags', []):
+        if tag['Key'] == tag_name and tag_value_matches(tag['Value'], tag_values):
+            return True
+    return False
+
+
+def resource_region(resource):
+    """Region of a resource, global resources without region in the ARN are collected in us-east-1"""
+    region = resource['ResourceARN'].split(':')[3]
+    if not region:
+        region = resource.get('Region', 'us-east-1')
+    return region
 
 
-def get_resources_from_api(resourcetaggingapi, resources, tag_name, tag_values):
+def chunk_tag_values(tag_values):
+    """Tagging API accepts only 5 values per tag filter"""
+    for tags_processed in range(0, max(len(tag_values), 1), 5):
+        yield tag_values[tags_processed:tags_processed+5]
+
+
+def get_resource_pages_from_api(resourcetaggingapi, tag_name, tag_values, type_filters=None):
+    if type_filters is None:
+        type_filters = []
     response = resourcetaggingapi.get_resources(
         TagFilters=[
             {
@@ -33,10 +117,11 @@ def get_resources_from_api(resourcetaggingapi, resources, tag_name, tag_values):
                 'Values': tag_values
             },
         ],
+        ResourceTypeFilters=type_filters,
         ResourcesPerPage=40
     )
 
-    resources.extend(response['ResourceTagMappingList'])
+    yield response['ResourceTagMappingList']
     while response['PaginationToken'] != '':
         print('Got the pagination token')
         response = resourcetaggingapi.get_resources(
@@ -47,147 +132,152 @@ def get_resources_from_api(resourcetaggingapi, resources, tag_name, tag_values):
                     'Values': tag_values
                 },
             ],
+            ResourceTypeFilters=type_filters,
             ResourcesPerPage=40
         )
-        resources.extend(response['ResourceTagMappingList'])
+        yield response['ResourceTagMappingList']
 
-    return resources
-
-def autoscaling_retriever(tag_name, tag_values, config):
-    resources = []
-    tags = len(tag_values)
-    if tags > 5:
-        tags_processed = 0
-        while tags_processed < tags:
-            incremental_tag_values = tag_values[tags_processed:tags_processed+5]
-            resources.extend(get_asgs_from_api(tag_name, incremental_tag_values, config))
-            tags_processed += 5
-    else:
-        resources.extend(get_asgs_from_api(tag_name, tag_values, config))
 
-    return resources
-
-
-def get_asgs_from_api(tag_name, tag_values, config):
-    """Autoscaling is not supported by resource groups and tagging api
-    This is
-    :return:
-    """
-    asg = boto3.client('autoscaling', config=config)
-    resources = []
+def get_asg_pages_from_api(tag_name, tag_values, config):
+    asg = get_client('autoscaling', config=config)
     response = asg.describe_auto_scaling_groups(
-        Filters=[
-            {
-                'Name': 'tag:'+tag_name,
-                'Values': tag_values
-            }
-        ],
+        Filters=[asg_tag_filter(tag_name, tag_values)],
         MaxRecords=10
     )
-    resources.extend(response['AutoScalingGroups'])
+    yield asg_page(response)
     try:
         while response['NextToken']:
             response = asg.describe_auto_scaling_groups(
                 NextToken=response['NextToken'],
-                Filters=[
-                    {
-                        'Name': 'tag:'+tag_name,
-                        'Values': tag_values
-                    }
-                ],
+                Filters=[asg_tag_filter(tag_name, tag_values)],
                 MaxRecords=10
             )
-            resources.extend(response['AutoScalingGroups'])
-    except:
+            yield asg_page(response)
+    except KeyError:
         print(f'Done fetching autoscaling groups')
 
-    for resource in resources:
-        resource['ResourceARN'] = resource['AutoScalingGroupARN']
 
-    return resources
+def asg_tag_filter(tag_name, tag_values):
+    """Filters on the tag values, or only on the tag key when no values are given"""
+    if not tag_values:
+        return {'Name': 'tag-key', 'Values': [tag_name]}
+    return {'Name': 'tag:'+tag_name, 'Values': tag_values}
 
-def cw_custom_namespace_retriever(config):
-    """Retrieving all custom namespaces
-    """
-    cw = boto3.client('cloudwatch', config=config)
-    resources = []
-    response = cw.list_metrics()
-    for record in response['Metrics']:
-        if not record['Namespace'].startswith('AWS/') and not record['Namespace'].startswith('CWAgent') and record['Namespace'] not in resources:
-            resources.append(record['Namespace'])
-            print(resources)
 
-    try:
-        while response['NextToken']:
-            response = cw.list_metrics(
-                NextToken = response['NextToken']
-            )
-            for record in response['Metrics']:
-                if not record['Namespace'].startswith('AWS/') and not record['Namespace'].startswith('CWAgent') and record['Namespace'] not in resources:
-                    resources.append(record['Namespace'])
-                    print(resources)
-    except:
-        print(f'Done fetching cloudwatch namespaces')
+def asg_page(response):
+    resources = response['AutoScalingGroups']
+    for resource in resources:
+        resource['ResourceARN'] = resource['AutoScalingGroupARN']
     return resources
 
-
-
-
-def router(resource, config):
-    arn = resource['ResourceARN']
+# Metrics that the widget sets check against the metric index (MetricIndex.filter) and the dimension they are charted
+# by. Other metrics are left out of the index, and MetricIndex treats them as always published.
+INDEXED_METRICS = {
+    'CWAgent': {
+        'Dimension': 'InstanceId',
+        'MetricNames': ['mem_used_percent', 'cpu_usage_iowait', 'netstat_tcp_established', 'netstat_tcp_time_wait',
+                        'disk_used_percent', 'swap_used_percent']
+    },
+    'AWS/ApiGateway': {
+        'Dimension': 'ApiName',
+        'MetricNames': ['CacheHitCount', 'CacheMissCount']
+    }
+}
+
+
+def cw_metric_retriever(config, instance_ids=None):
+    """Scans list_metrics once for a region and returns the custom namespaces together with a metric
+    index of namespace -> metric name -> dimension sets for the metrics in INDEXED_METRICS. CloudWatch agent
+    metrics are only kept for instance_ids, the instances collected in the region.
+    """
+    cw = get_client('cloudwatch', config=config)
+    namespaces = []
+    metrics = {namespace: {metric_name: [] for metric_name in indexed['MetricNames']}
+               for namespace, indexed in INDEXED_METRICS.items()}
+    for response in cw.get_paginator('list_metrics').paginate():
+        for record in response['Metrics']:
+            if not record['Namespace'].startswith('AWS/') and not record['Namespace'].startswith('CWAgent') and record['Namespace'] not in namespaces:
+                namespaces.append(record['Namespace'])
+                print(namespaces)
+            indexed = INDEXED_METRICS.get(record['Namespace'])
+            if not indexed or record['MetricName'] not in indexed['MetricNames']:
+                continue
+            if [dimension['Name'] for dimension in record['Dimensions']] != [indexed['Dimension']]:
+                continue
+            if indexed['Dimension'] == 'InstanceId' and record['Dimensions'][0]['Value'] not in (instance_ids or ()):
+                continue
+            metrics[record['Namespace']][record['MetricName']].append(dimension_set(record['Dimensions']))
+    print(f'Done fetching cloudwatch namespaces and metrics')
+    return namespaces, metrics
+
+
+def dimension_set(dimensions):
+    """Dimensions as Name=Value pairs sorted by name, the same format graphfactory uses for lookups"""
+    return ','.join(f'{dimension["Name"]}={dimension["Value"]}' for dimension in sorted(dimensions, key=lambda d: d['Name']))
+
+
+def resource_type(arn):
+    """Resource type names used by router() and the --services filter"""
     if ':apigateway:' in arn and '/restapis/' in arn and 'stages' not in arn:
-        resource = apigw1_decorator(resource, config)
+        return 'apigw1'
     elif ':apigateway:' in arn and '/apis/' in arn and 'stages' not in arn:
-        resource = apigw2_decorator(resource, config)
+        return 'apigw2'
     elif ':appsync:' in arn:
-        resource = appsync_decorator(resource, config)
+        return 'appsync'
     elif ':rds:' in arn and ':cluster:' in arn:
-        resource = aurora_decorator(resource, config)
+        return 'aurora'
     elif ':autoscaling:' in arn and ':autoScalingGroup:' in arn:
-        resource = autoscaling_decorator(resource, config)
+        return 'autoscaling'
     elif ':capacity-reservation/' in arn:
-        resource = odcr_decorator(resource, config)
+        return 'odcr'
     elif ':dynamodb:' in arn and ':table/' in arn:
-        resource = dynamodb_decorator(resource, config)
+        return 'dynamodb'
     elif ':ec2:' in arn and ':instance/' in arn:
-        resource = ec2_decorator(resource, config)
+        return 'ec2'
     elif 'lambda' in arn and 'function' in arn:
-        resource = lambda_decorator(resource, config)
+        return 'lambda'
     elif 'elasticloadbalancing' in arn and '/net/' not in arn and '/app/' not in arn and ':targetgroup/' not in arn:
-        resource = elb1_decorator(resource, config)
+        return 'elb1'
     elif 'elasticloadbalancing' in arn and ( '/net/' in arn or '/app/' in arn ) and ':targetgroup/' not in arn and ':listener/' not in arn:
-        resource = elb2_decorator(resource, config)
+        return 'elb2'
     elif ':ecs:' in arn and ':cluster/' in arn:
-        resource = ecs_decorator(resource, config)
+        return 'ecs'
     elif ':natgateway/' in arn and ':ec2:' in arn:
-        resource = natgw_decorator(resource, config)
+        return 'natgw'
     elif ':transit-gateway/' in arn and ':ec2:' in arn:
-        resource = tgw_decorator(resource, config)
+        return 'tgw'
     elif ':sqs:' in arn:
-        resource = sqs_decorator(resource, config)
+        return 'sqs'
     elif 'arn:aws:s3:' in arn:
-        resource = s3_decorator(resource, config)
+        return 's3'
     elif ':sns:' in arn:
-        resource = sns_decorator(resource, config)
+        return 'sns'
     elif ':cloudfront:' in arn and ':distribution/' in arn:
-        resource = cloudfront_decorator(resource, config)
+        return 'cloudfront'
     elif ':elasticache:' in arn:
-        resource = elasticache_decorator(resource, config)
+        return 'elasticache'
     elif ':mediapackage:' in arn and ':channels/' in arn:
-        resource = mediapackage_decorator(resource, config)
+        return 'mediapackage'
     elif ':medialive:' in arn and ':channel:' in arn:
-        resource = medialive_decorator(resource, config)
+        return 'medialive'
     elif ':elasticfilesystem:' in arn:
-        resource = efs_decorator(resource, config)
+        return 'efs'
     elif 'arn:aws:elasticbeanstalk:' in arn:
-        resource = beanstalk_decorator(resource,config)
+        return 'beanstalk'
+    return None
+
+
+def router(resource, config):
+    decorator = DECORATORS.get(resource_type(resource['ResourceARN']))
+    if decorator:
+        resource = decorator(resource, config)
     return resource
 
 
 def apigw1_decorator(resource, config):
     print(f'This resource is API Gateway 1 {resource["ResourceARN"]}')
     apiid = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    apigw = boto3.client('apigateway', config=config)
+    apigw = get_client('apigateway', config=config)
     response = apigw.get_rest_api(
         restApiId=apiid
     )
@@ -203,7 +293,7 @@ def apigw1_decorator(resource, config):
 def apigw2_decorator(resource, config):
     print(f'This resource is API Gateway 2 {resource["ResourceARN"]}')
     apiid = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/')) - 1]
-    apigw = boto3.client('apigatewayv2', config=config)
+    apigw = get_client('apigatewayv2', config=config)
     response = apigw.get_api(
         ApiId=apiid
     )
@@ -218,7 +308,7 @@ def apigw2_decorator(resource, config):
 def appsync_decorator(resource, config):
     print(f'This resource is AppSync {resource["ResourceARN"]}')
     apiid = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/')) - 1]
-    appsync = boto3.client('appsync', config=config)
+    appsync = get_client('appsync', config=config)
     response = appsync.get_graphql_api(
         apiId=apiid
     )
@@ -234,7 +324,7 @@ def appsync_decorator(resource, config):
 def aurora_decorator(resource, config):
     print(f'This resource is Aurora {resource["ResourceARN"]}')
     clusterid = resource['ResourceARN'].split(':')[len(resource['ResourceARN'].split(':')) - 1]
-    rds = boto3.client('rds', config=config)
+    rds = get_client('rds', config=config)
     try:
         response = rds.describe_db_clusters(
             DBClusterIdentifier=clusterid
@@ -266,7 +356,7 @@ def beanstalk_decorator(resource, config):
 
 def cloudfront_decorator(resource, config):
     print(f'This resource is CloudFront distribution')
-    client = boto3.client('cloudfront', config=config)
+    client = get_client('cloudfront', config=config)
     response = client.get_distribution(
         Id = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
     )
@@ -280,7 +370,7 @@ def cloudfront_decorator(resource, config):
 def mediapackage_decorator(resource, config):
     print(f'this resource is Mediapackage channel')
     arn = resource['ResourceARN']
-    client = boto3.client('mediapackage', config=config)
+    client = get_client('mediapackage', config=config)
     response = client.list_channels(
         MaxResults=40,
     
@@ -300,7 +390,7 @@ def mediapackage_decorator(resource, config):
 def medialive_decorator(resource, config):
     print(f'this resource is Medialive channel')
     arn = resource['ResourceARN']
-    client = boto3.client('medialive', config=config)
+    client = get_client('medialive', config=config)
     response = client.list_channels(
         MaxResults=40,
     )
@@ -322,7 +412,7 @@ def odcr_decorator(resource, config):
 def dynamodb_decorator(resource, config):
     print(f'This resource is DynamoDB {resource["ResourceARN"]}')
     tablename = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    ddb = boto3.client('dynamodb', config=config)
+    ddb = get_client('dynamodb', config=config)
     response = ddb.describe_table(
         TableName=tablename
     )
@@ -342,7 +432,7 @@ def dynamodb_decorator(resource, config):
 def efs_decorator(resource, config):
     print(f'This resource is EFS {resource["ResourceARN"]}')
     fsId = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    efs = boto3.client('efs', config=config)
+    efs = get_client('efs', config=config)
     response = efs.describe_file_systems(
         FileSystemId=fsId
     )
@@ -354,7 +444,7 @@ def efs_decorator(resource, config):
 def ec2_decorator(resource, config):
     print(f'This resource is EC2 {resource["ResourceARN"]}')
     instanceid = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    ec2 = boto3.client('ec2', config=config)
+    ec2 = get_client('ec2', config=config)
 
     volumes = []
 
@@ -415,7 +505,7 @@ def ec2_decorator(resource, config):
         )
         resource['CPUCreditSpecs'] = response['InstanceCreditSpecifications'][0]
 
-    cw = boto3.client('cloudwatch', config=config)
+    cw = get_client('cloudwatch', config=config)
     results = cw.get_paginator('list_metrics')
     for response in results.paginate(
             MetricName='mem_used_percent',
@@ -436,7 +526,7 @@ def elasticache_decorator(resource, config):
     print(f'This resource is Elasticache {resource["ResourceARN"]}')
     if ':cluster:' in resource['ResourceARN']:
         clusterid = resource['ResourceARN'].split(':')[len(resource['ResourceARN'].split(':'))-1]
-        client = boto3.client('elasticache', config=config)
+        client = get_client('elasticache', config=config)
         response = client.describe_cache_clusters(
             CacheClusterId=clusterid
         )
@@ -457,7 +547,7 @@ def elasticache_decorator(resource, config):
 def lambda_decorator(resource, config):
     print(f'This resource is Lambda {resource["ResourceARN"]}')
     functionname = resource['ResourceARN'].split(':')[len(resource['ResourceARN'].split(':')) - 1]
-    lambdaclient = boto3.client('lambda', config=config)
+    lambdaclient = get_client('lambda', config=config)
     response = lambdaclient.get_function(
         FunctionName=functionname
     )
@@ -468,7 +558,7 @@ def lambda_decorator(resource, config):
 def elb1_decorator(resource, config):
     print(f'This resource is ELBv1 {resource["ResourceARN"]}')
     elbname = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    elb = boto3.client('elb', config=config)
+    elb = get_client('elb', config=config)
     response = elb.describe_load_balancers(
        LoadBalancerNames=[
            elbname
@@ -480,7 +570,7 @@ def elb1_decorator(resource, config):
 
 def elb2_decorator(resource, config):
     print(f'This resource is ELBv2 {resource["ResourceARN"]}')
-    elb = boto3.client('elbv2', config=config)
+    elb = get_client('elbv2', config=config)
     response = elb.describe_load_balancers(
         LoadBalancerArns=[
             resource['ResourceARN']
@@ -496,7 +586,7 @@ def elb2_decorator(resource, config):
 
 def ecs_decorator(resource, config):
     print(f'This resource is ECS {resource["ResourceARN"]}')
-    ecs = boto3.client('ecs', config=config)
+    ecs = get_client('ecs', config=config)
     response = ecs.describe_clusters(
         clusters=[
             resource['ResourceARN']
@@ -522,7 +612,7 @@ def ecs_decorator(resource, config):
             for lb in service['loadBalancers']:
                 target_groups.append(lb['targetGroupArn'])
 
-        elb = boto3.client('elbv2', config=config)
+        elb = get_client('elbv2', config=config)
         for target_group in target_groups:
             response = elb.describe_target_health(
                 TargetGroupArn=target_group
@@ -551,7 +641,7 @@ def s3_decorator(resource, config):
     bucket_name = resource['ResourceARN'].split(':')[len(resource['ResourceARN'].split(':'))-1]
     resource['BucketName'] = bucket_name
     print(f'This resource {bucket_name} is S3 bucket')
-    s3client = boto3.client('s3', config=config)
+    s3client = get_client('s3', config=config)
     try:
         encryption_request = s3client.get_bucket_encryption(
             Bucket=bucket_name
@@ -581,7 +671,7 @@ def s3_decorator(resource, config):
 def sqs_decorator(resource, config):
     print(f'This resource is SQS {resource["ResourceARN"]}')
     queueName = resource['ResourceARN'].split(':')[len(resource['ResourceARN'].split(':'))-1]
-    sqs = boto3.client('sqs', config=config)
+    sqs = get_client('sqs', config=config)
     response = sqs.get_queue_url(
         QueueName=queueName
     )
@@ -607,7 +697,7 @@ def sns_decorator(resource, config):
 def tgw_decorator(resource, config):
     print(f'This resource is TGW {resource["ResourceARN"]}')
     tgwid = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    tgw = boto3.client('ec2', config=config)
+    tgw = get_client('ec2', config=config)
     response = tgw.describe_transit_gateway_attachments(
         Filters=[{
             'Name': 'transit-gateway-id',
@@ -621,6 +711,60 @@ def tgw_decorator(resource, config):
     return resource
 
 
+DECORATORS = {
+    'apigw1': apigw1_decorator,
+    'apigw2': apigw2_decorator,
+    'appsync': appsync_decorator,
+    'aurora': aurora_decorator,
+    'autoscaling': autoscaling_decorator,
+    'odcr': odcr_decorator,
+    'dynamodb': dynamodb_decorator,
+    'ec2': ec2_decorator,
+    'lambda': lambda_decorator,
+    'elb1': elb1_decorator,
+    'elb2': elb2_decorator,
+    'ecs': ecs_decorator,
+    'natgw': natgw_decorator,
+    'tgw': tgw_decorator,
+    'sqs': sqs_decorator,
+    's3': s3_decorator,
+    'sns': sns_decorator,
+    'cloudfront': cloudfront_decorator,
+    'elasticache': elasticache_decorator,
+    'mediapackage': mediapackage_decorator,
+    'medialive': medialive_decorator,
+    'efs': efs_decorator,
+    'beanstalk': beanstalk_decorator
+}
+
+# ResourceTypeFilters of the tagging API for every router resource type, autoscaling groups come from their own API
+TAGGING_RESOURCE_TYPES = {
+    'apigw1': 'apigateway:restapis',
+    'apigw2': 'apigateway:apis',
+    'appsync': 'appsync:apis',
+    'aurora': 'rds:cluster',
+    'autoscaling': None,
+    'odcr': 'ec2:capacity-reservation',
+    'dynamodb': 'dynamodb:table',
+    'ec2': 'ec2:instance',
+    'lambda': 'lambda:function',
+    'elb1': 'elasticloadbalancing:loadbalancer',
+    'elb2': 'elasticloadbalancing:loadbalancer',
+    'ecs': 'ecs:cluster',
+    'natgw': 'ec2:natgateway',
+    'tgw': 'ec2:transit-gateway',
+    'sqs': 'sqs',
+    's3': 's3',
+    'sns': 'sns',
+    'cloudfront': 'cloudfront:distribution',
+    'elasticache': 'elasticache',
+    'mediapackage': 'mediapackage:channels',
+    'medialive': 'medialive:channel',
+    'efs': 'elasticfilesystem',
+    'beanstalk': 'elasticbeanstalk'
+}
+
+
 def debug(resource):
     print(json.dumps(resource, indent=4, default=str))
 
@@ -634,12 +778,481 @@ def get_config(region):
         }
     )
 
-def handler():
+
+def get_client(service, config):
+    """boto3 sessions are not thread safe, so every pipeline thread keeps its own session
+    and reuses its clients per service and region.
+    """
+    if not hasattr(clients, 'session'):
+        if cassette and cassette.mode == 'replay':
+            clients.session = boto3.session.Session(aws_access_key_id='replay', aws_secret_access_key='replay')
+        else:
+            clients.session = boto3.session.Session()
+        clients.pool = {}
+    key = (service, config.region_name)
+    if key not in clients.pool:
+        clients.pool[key] = clients.session.client(service, config=config)
+        if cassette:
+            cassette.attach(clients.pool[key])
+    return clients.pool[key]
+
+
+class Cassette:
+    """Records every AWS response the collector receives into a gzip compressed JSON file keyed by
+    region, service, operation and request parameters, or replays them so the collector runs offline.
+    """
+    def __init__(self, cassette_file, mode):
+        self.cassette_file = cassette_file
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.responses = {}
+        if mode == 'replay':
+            with gzip.open(cassette_file, 'rt') as f:
+                self.responses = json.load(f)
+            print(f'Replaying {len(self.responses)} responses from {cassette_file}')
+
+    def attach(self, client):
+        client.meta.events.register('before-parameter-build', self.key_request)
+        if self.mode == 'record':
+            client.meta.events.register('after-call', self.record)
+        else:
+            client.meta.events.register('before-call', self.replay)
+
+    def key_request(self, params, model, context, **kwargs):
+        context['cassette_key'] = '/'.join([
+            context['client_region'],
+            model.service_model.service_name,
+            model.name,
+            json.dumps(params, sort_keys=True, default=str)
+        ])
+
+    def record(self, http_response, parsed, context, **kwargs):
+        response = {key: value for key, value in parsed.items() if key != 'ResponseMetadata'}
+        with self.lock:
+            self.responses[context['cassette_key']] = {
+                'StatusCode': http_response.status_code,
+                'Response': json.loads(json.dumps(response, default=str))
+            }
+
+    def replay(self, context, **kwargs):
+        if context['cassette_key'] not in self.responses:
+            raise LookupError(f'No recorded response for {context["cassette_key"]}')
+        recorded = self.responses[context['cassette_key']]
+        return AWSResponse(None, recorded['StatusCode'], {}, None), json.loads(json.dumps(recorded['Response']))
+
+    def save(self):
+        if self.mode != 'record':
+            return
+        with gzip.open(self.cassette_file, 'wt') as f:
+            json.dump(self.responses, f)
+        print(f'Recorded {len(self.responses)} responses to {self.cassette_file}')
+
+
+class GroupingIndex:
+    """Index of GroupingTagKey values built while resources are written:
+    group value -> resource type -> ARNs and offsets in the resource file, plus counts.
+    """
+    def __init__(self, grouping_tag_key):
+        self.grouping_tag_key = grouping_tag_key
+        self.groups = {}
+
+    def add(self, resource, offset):
+        for tag in resource.get('Tags', []):
+            if tag['Key'] == self.grouping_tag_key:
+                group = self.groups.setdefault(tag['Value'], {})
+                entry = group.setdefault(resource_type(resource['ResourceARN']) or 'other', {'Count': 0, 'Arns': [], 'Offsets': []})
+                entry['Count'] += 1
+                entry['Arns'].append(resource['ResourceARN'])
+                entry['Offsets'].append(offset)
+                break
+
+    def save(self, grouping_index_file):
+        gi = open(grouping_index_file, "w")
+        gi.write(json.dumps({'GroupingTagKey': self.grouping_tag_key, 'Groups': self.groups}, indent=4))
+        gi.close()
+
+
+class ResourceWriter:
+    """Streams decorated resources into the resource file as a JSON array.
+    Output goes to a temporary file that replaces the resource file only when the collection completes,
+    the temporary file is removed when it fails.
+    """
+    def __init__(self, output_file, grouping_index=None):
+        self.output_file = output_file
+        self.temp_file = f'{output_file}.tmp'
+        self.file = open(self.temp_file, "w")
+        self.grouping_index = grouping_index
+        self.count = 0
+
+    def write(self, resource):
+        item = json.dumps(resource, indent=4, default=str).replace('\n', '\n    ')
+        self.file.write(('[\n    ' if self.count == 0 else ',\n    ') + item)
+        if self.grouping_index:
+            self.grouping_index.add(resource, self.count)
+        self.count += 1
+
+    def close(self):
+        self.file.write('\n]' if self.count > 0 else '[]')
+        self.file.close()
+        os.replace(self.temp_file, self.output_file)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.temp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def decoration_pipeline(discovery, emit, workers=8, max_in_flight=100, on_error=None):
+    """Runs router() for resources while discovery keeps paginating.
+    discovery yields (resource, config) tuples, emit receives decorated resources in discovery order.
+    At most max_in_flight resources are queued, being decorated or waiting to be emitted, which
+    blocks discovery (backpressure) and keeps memory flat regardless of the number of resources.
+    A failed decoration aborts the pipeline unless on_error(resource, error) is given, which is called instead.
+    """
+    tasks = queue.Queue(maxsize=max_in_flight)
+    results = queue.Queue()
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    discovery_errors = []
+
+    def discover():
+        try:
+            for sequence, (resource, config) in enumerate(discovery):
+                in_flight.acquire()
+                tasks.put((sequence, resource, config))
+        except Exception as e:
+            discovery_errors.append(e)
+        finally:
+            for _ in range(workers):
+                tasks.put(None)
+
+    def decorate():
+        while True:
+            task = tasks.get()
+            if task is None:
+                results.put(None)
+                return
+            sequence, resource, config = task
+            try:
+                results.put((sequence, router(resource, config), None))
+            except Exception as e:
+                print(f'Failed to decorate {resource["ResourceARN"]}')
+                results.put((sequence, resource, e))
+
+    threads = [threading.Thread(target=discover, daemon=True)]
+    threads.extend(threading.Thread(target=decorate, daemon=True) for _ in range(workers))
+    for thread in threads:
+        thread.start()
+
+    pending = {}
+    next_sequence = 0
+    finished_workers = 0
+    while finished_workers < workers:
+        result = results.get()
+        if result is None:
+            finished_workers += 1
+            continue
+        sequence, resource, error = result
+        if error is not None and on_error is None:
+            raise error
+        pending[sequence] = (resource, error)
+        while next_sequence in pending:
+            resource, error = pending.pop(next_sequence)
+            if error is None:
+                emit(resource)
+            else:
+                on_error(resource, error)
+            in_flight.release()
+            next_sequence += 1
+
+    if discovery_errors:
+        raise discovery_errors[0]
+    return next_sequence
+
+
+def discover_regions(regions, tag_name, tag_values, region_namespaces=None, resource_types=None, arns=None, region_metrics=None):
+    for region in regions:
+        config = get_config(region)
+        if arns is None:
+            pages = discover_resource_pages(tag_name, tag_values, config, resource_types)
+        else:
+            region_arns = [arn for arn in arns if arn.split(':')[3] in (region, '')]
+            pages = discover_arn_pages(region_arns, tag_name, tag_values, config)
+        instance_ids = set()
+        for page in pages:
+            for resource in page:
+                if resource_types is None or resource_type(resource['ResourceARN']) in resource_types:
+                    if resource_type(resource['ResourceARN']) == 'ec2':
+                        instance_ids.add(resource['ResourceARN'].split('/')[-1])
+                    yield resource, config
+        if region_namespaces is not None:
+            namespaces, metrics = cw_metric_retriever(config, instance_ids)
+            region_namespaces['RegionNamespaces'].append({'Region': region, 'Namespaces': namespaces})
+            region_metrics['RegionMetrics'].append({'Region': region, 'Metrics': metrics})
+
+
+def probe_regions(tag_name, tag_values, workers=8):
+    """Finds the enabled regions that have resources tagged with tag_name and one of tag_values.
+    Every region is probed concurrently with get_tag_values and a single record autoscaling lookup.
+    """
+    ec2 = get_client('ec2', config=get_config('us-east-1'))
+    enabled_regions = [region['RegionName'] for region in ec2.describe_regions()['Regions']]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        probes = list(executor.map(lambda region: region_has_resources(region, tag_name, tag_values), enabled_regions))
+    regions = [region for region, has_resources in zip(enabled_regions, probes) if has_resources]
+    print(f'Found tagged resources in {regions} out of {len(enabled_regions)} enabled regions')
+    return regions
+
+
+def region_has_resources(region, tag_name, tag_values):
+    config = get_config(region)
+    try:
+        resourcetaggingapi = get_client('resourcegroupstaggingapi', config=config)
+        for response in resourcetaggingapi.get_paginator('get_tag_values').paginate(Key=tag_name):
+            for value in response['TagValues']:
+                if tag_value_matches(value, tag_values):
+                    return True
+        asg = get_client('autoscaling', config=config)
+        # patterns are probed on the tag key only
+        asg_tag_values = [] if has_tag_patterns(tag_values) else tag_values
+        for incremental_tag_values in chunk_tag_values(asg_tag_values):
+            response = asg.describe_auto_scaling_groups(
+                Filters=[asg_tag_filter(tag_name, incremental_tag_values)],
+                MaxRecords=1
+            )
+            if response['AutoScalingGroups']:
+                return True
+    except Exception as e:
+        print(f'Could not probe {region}, collecting it anyway: {e}')
+        return True
+    return False
+
+
+def load_probed_regions(probe_cache_file, tag_name, tag_values, ttl_hours):
+    """Regions from a previous probe for the same tag key and values that is younger than ttl_hours"""
+    try:
+        with open(probe_cache_file, "r") as f:
+            probe = json.load(f)
+    except FileNotFoundError:
+        return None
+    if probe['TagKey'] != tag_name or probe['TagValues'] != tag_values or time.time() - probe['Timestamp'] > ttl_hours * 3600:
+        print(f'Region probe cache {probe_cache_file} is stale')
+        return None
+    print(f'Using probed regions {probe["Regions"]} from {probe_cache_file}')
+    return probe['Regions']
+
+
+def save_probed_regions(probe_cache_file, tag_name, tag_values, regions):
+    pc = open(probe_cache_file, "w")
+    pc.write(json.dumps({'Timestamp': time.time(), 'TagKey': tag_name, 'TagValues': tag_values, 'Regions': regions}, indent=4))
+    pc.close()
+
+
+def refresh_resources(output_file, discovery, in_scope, workers, max_in_flight, grouping_index=None,
+                      keep_failed=False):
+    """Re-collects a slice of the resources and merges it into the existing resource file by ARN.
+    Resources in scope that weren't discovered again are removed, everything else is kept as is.
+    With keep_failed a resource that fails decoration doesn't abort the refresh: it is removed when it no
+    longer exists and keeps its previous record otherwise.
+    """
+    refreshed = {}
+    failed_arns = set()
+
+    def collect(resource):
+        refreshed[resource['ResourceARN']] = resource
+
+    def skip(resource, error):
+        if is_not_found(error):
+            print(f'{resource["ResourceARN"]} no longer exists: {error}')
+        else:
+            print(f'Keeping the previous record of {resource["ResourceARN"]}: {error}')
+            failed_arns.add(resource['ResourceARN'])
+
+    decoration_pipeline(discovery, collect, workers, max_in_flight, skip if keep_failed else None)
+    print(f'Refreshed {len(refreshed)} resources')
+
+    existing = []
+    try:
+        with open(output_file, "r") as f:
+            existing = json.load(f)
+    except FileNotFoundError:
+        print(f'No existing {output_file}, writing only refreshed resources')
+
+    with ResourceWriter(output_file, grouping_index) as writer:
+        for resource in existing:
+            if resource['ResourceARN'] in refreshed:
+                writer.write(refreshed.pop(resource['ResourceARN']))
+            elif in_scope(resource) and resource['ResourceARN'] not in failed_arns:
+                print(f'Removing {resource["ResourceARN"]}')
+            else:
+                writer.write(resource)
+        for resource in refreshed.values():
+            writer.write(resource)
+    return writer.count
+
+
+def is_not_found(error):
+    """Whether a decorator failed because the resource no longer exists"""
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code', '')
+    return 'NotFound' in code or code.startswith('NoSuch') or 'DoesNotExist' in code
+
+
+# CloudTrail event name prefixes of API calls that delete a resource, for example DeleteTable, TerminateInstances
+# or RemoveSourceIdentifierFromSubscription. Tag API calls such as DeleteTags or RemoveTagsFromResource only change tags.
+DELETION_EVENT_PREFIXES = ('Delete', 'Terminate', 'Remove')
+
+
+def resource_event_changes(event):
+    """ARNs affected by a resource change event and whether the resources were deleted.
+    Accepts EventBridge events (for example tag changes or CloudTrail API calls) that list the resources
+    and the local format {"action": "create|update|delete", "arn": "..."}.
+    """
+    if 'action' in event:
+        return [event['arn']], event['action'] == 'delete'
+    event_name = event.get('detail', {}).get('eventName', '')
+    deleted = event_name.startswith(DELETION_EVENT_PREFIXES) and 'Tag' not in event_name
+    return event.get('resources', []), deleted
+
+
+def apply_resource_events(events, output_file, tag_name, tag_values, workers, max_in_flight, grouping_index=None):
+    """Re-decorates the resources affected by the events, drops deleted and untagged ones and rewrites
+    the resource file atomically. Returns the number of resources in the file.
+    """
+    refresh_arns = set()
+    deleted_arns = set()
+    regions = set()
+    for event in events:
+        arns, deleted = resource_event_changes(event)
+        if not arns:
+            print(f'No resources in event {event.get("id", "")} {event.get("detail-type", "")}: {json.dumps(event, default=str)[:500]}')
+        for arn in arns:
+            if deleted:
+                deleted_arns.add(arn)
+                refresh_arns.discard(arn)
+            else:
+                refresh_arns.add(arn)
+                deleted_arns.discard(arn)
+            regions.add(arn.split(':')[3] or event.get('region', 'us-east-1'))
+
+    if not refresh_arns and not deleted_arns:
+        print('No resource changes in events')
+        return None
+
+    print(f'Applying {len(refresh_arns)} changed and {len(deleted_arns)} deleted resources')
+    affected_arns = refresh_arns | deleted_arns
+    discovery = discover_regions(sorted(regions), tag_name, tag_values, arns=sorted(refresh_arns))
+    return refresh_resources(output_file, discovery, lambda resource: resource['ResourceARN'] in affected_arns,
+                             workers, max_in_flight, grouping_index, keep_failed=True)
+
+
+def read_events_file(events_file):
+    """Events as a JSON array, a single JSON event or one JSON event per line"""
+    with open(events_file, "r") as f:
+        content = f.read()
+    try:
+        events = json.loads(content)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+    return events if isinstance(events, list) else [events]
+
+
+def get_queue_region(queue_url):
+    """Region of an sqs.<region>.amazonaws.com or legacy <region>.queue.amazonaws.com queue URL,
+    None for other hosts so that the configured region is used.
+    """
+    host = urlparse(queue_url).hostname or ''
+    parts = host.split('.')
+    if len(parts) >= 4 and parts[0] == 'sqs':
+        return parts[1]
+    if len(parts) >= 4 and parts[1] == 'queue':
+        return parts[0]
+    return None
+
+
+def consume_event_queue(queue_url, apply_events, follow=False, batch_size=100, region=None, max_receives=5):
+    """Applies resource change events from an SQS queue in batches of up to batch_size events.
+    Messages are deleted only after the batch has been written. With follow the queue is polled until interrupted
+    and a batch that fails is left in the queue, to be received again or moved to the dead-letter queue of its redrive
+    policy. Messages received more than max_receives times or that aren't JSON are logged and deleted unapplied.
+    """
+    sqs = get_client('sqs', config=get_config(region or get_queue_region(queue_url)))
+    while True:
+        messages = []
+        while len(messages) < batch_size:
+            response = sqs.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=0 if messages else 20,
+                AttributeNames=['ApproximateReceiveCount']
+            )
+            if not response.get('Messages'):
+                break
+            messages.extend(response['Messages'])
+
+        if messages:
+            events = []
+            for message in messages:
+                if int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)) > max_receives:
+                    print(f'Dropping message {message["MessageId"]} received more than {max_receives} times: {message["Body"][:500]}')
+                    continue
+                try:
+                    events.append(json.loads(message['Body']))
+                except json.JSONDecodeError:
+                    print(f'Dropping message {message["MessageId"]} that is not JSON: {message["Body"][:500]}')
+            try:
+                if events:
+                    apply_events(events)
+            except Exception as e:
+                if not follow:
+                    raise
+                print(f'Failed to apply {len(events)} events, leaving them in the queue: {e}')
+                continue
+            for offset in range(0, len(messages), 10):
+                sqs.delete_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=[{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']}
+                             for i, message in enumerate(messages[offset:offset+10])]
+                )
+        elif not follow:
+            return
+
+
+def merge_regions(region_file, refreshed, key):
+    """Keeps the entries of regions that weren't refreshed from an existing per-region file"""
+    try:
+        with open(region_file, "r") as f:
+            existing = json.load(f)
+    except FileNotFoundError:
+        return refreshed
+    refreshed_regions = [entry['Region'] for entry in refreshed[key]]
+    for entry in existing.get(key, []):
+        if entry['Region'] not in refreshed_regions:
+            refreshed[key].append(entry)
+    return refreshed
+
+def handler(record_file=None, replay_file=None, refresh_regions=None, refresh_services=None, refresh_arns=None, auto_regions=False,
+            events_file=None, queue_url=None, follow=False, queue_region=None):
+    global cassette
     tag_name = 'iem'
     tag_values = ['202202', '202102']
     regions = ['eu-west-1', 'eu-north-1']
     output_file = "resources.json"
     custom_namespace_file = "custom_namespaces.json"
+    metric_index_file = "metric_index.json"
+    grouping_tag_key = None
+    grouping_index_file = "grouping_index.json"
+    workers = 8
+    max_in_flight = 100
+    probe_cache_file = None
+    probe_cache_ttl = 24
     try:
         f = open("../lib/config.json", "r")
         main_config = json.load(f)
@@ -671,31 +1284,148 @@ def handler():
     except:
         print('No regions configured')
 
+    try:
+        if main_config['AutoRegions']:
+            auto_regions = True
+    except:
+        print('No automatic region discovery configured')
+
+    try:
+        if main_config['RegionProbeCacheFile']:
+            probe_cache_file = main_config['RegionProbeCacheFile']
+    except:
+        print('No region probe cache configured')
+
+    try:
+        if main_config['RegionProbeCacheTTL']:
+            probe_cache_ttl = float(main_config['RegionProbeCacheTTL'])
+    except:
+        print(f'No region probe cache TTL configured using default {probe_cache_ttl} hours')
+
     try:
         if main_config['CustomNamespaceFile']:
             custom_namespace_file = main_config['CustomNamespaceFile']
     except:
         print('No custom namespaces configured')
 
-    decorated_resources = []
-    region_namespaces = {'RegionNamespaces': []}
-    if 'us-east-1' not in regions:
-        regions.append('us-east-1')
-        print('Added us-east-1 region for global services')
+    try:
+        if main_config['MetricIndexFile']:
+            metric_index_file = main_config['MetricIndexFile']
+    except:
+        print('No metric index file configured using default')
 
-    for region in regions:
-        config = get_config(region)
-        resources = get_resources(tag_name, tag_values, config)
-        region_namespace = {'Region': region, 'Namespaces' : cw_custom_namespace_retriever(config) }
-        region_namespaces['RegionNamespaces'].append(region_namespace)
-        for resource in resources:
-            decorated_resources.append(router(resource, config))
-    cn = open(custom_namespace_file, "w")
-    cn.write(json.dumps(region_namespaces, indent=4, default=str))
-    cn.close()
-    n = open(output_file, "w")
-    n.write(json.dumps(decorated_resources, indent=4, default=str))
-    n.close()
+    try:
+        if main_config['GroupingTagKey']:
+            grouping_tag_key = main_config['GroupingTagKey']
+    except:
+        print('No grouping tag key configured')
+
+    try:
+        if main_config['GroupingIndexFile']:
+            grouping_index_file = main_config['GroupingIndexFile']
+    except:
+        print('No grouping index file configured using default')
+
+    try:
+        if main_config['CollectorWorkers']:
+            workers = int(main_config['CollectorWorkers'])
+    except:
+        print(f'No collector workers configured using default {workers}')
+
+    try:
+        if main_config['CollectorMaxInFlight']:
+            max_in_flight = int(main_config['CollectorMaxInFlight'])
+    except:
+        print(f'No collector max in flight configured using default {max_in_flight}')
+
+    if record_file:
+        cassette = Cassette(record_file, 'record')
+    elif replay_file:
+        cassette = Cassette(replay_file, 'replay')
+
+    if events_file or queue_url:
+        def apply_events(events):
+            grouping_index = GroupingIndex(grouping_tag_key) if grouping_tag_key else None
+            count = apply_resource_events(events, output_file, tag_name, tag_values, workers, max_in_flight, grouping_index)
+            if count is not None:
+                print(f'Wrote {count} resources to {output_file}')
+                if grouping_index:
+                    grouping_index.save(grouping_index_file)
+
+        if events_file:
+            apply_events(read_events_file(events_file))
+        if queue_url:
+            consume_event_queue(queue_url, apply_events, follow, region=queue_region)
+        if cassette:
+            cassette.save()
+        return
+
+    region_namespaces = {'RegionNamespaces': []}
+    region_metrics = {'RegionMetrics': []}
+    grouping_index = GroupingIndex(grouping_tag_key) if grouping_tag_key else None
+    if refresh_regions:
+        regions = refresh_regions
+    else:
+        if auto_regions:
+            probed_regions = None
+            if probe_cache_file:
+                probed_regions = load_probed_regions(probe_cache_file, tag_name, tag_values, probe_cache_ttl)
+            if probed_regions is None:
+                probed_regions = probe_regions(tag_name, tag_values, workers)
+                if probe_cache_file:
+                    save_probed_regions(probe_cache_file, tag_name, tag_values, probed_regions)
+            regions = list(probed_regions)
+        if 'us-east-1' not in regions:
+            regions.append('us-east-1')
+            print('Added us-east-1 region for global services')
+
+    if refresh_regions or refresh_services or refresh_arns:
+        def in_scope(resource):
+            return (resource_region(resource) in regions
+                    and (not refresh_services or resource_type(resource['ResourceARN']) in refresh_services)
+                    and (not refresh_arns or resource['ResourceARN'] in refresh_arns))
+
+        if refresh_services or refresh_arns:
+            region_namespaces = None
+            region_metrics = None
+        discovery = discover_regions(regions, tag_name, tag_values, region_namespaces, refresh_services, refresh_arns, region_metrics)
+        count = refresh_resources(output_file, discovery, in_scope, workers, max_in_flight, grouping_index)
+        print(f'Wrote {count} resources to {output_file}')
+        if region_namespaces is not None:
+            region_namespaces = merge_regions(custom_namespace_file, region_namespaces, 'RegionNamespaces')
+            region_metrics = merge_regions(metric_index_file, region_metrics, 'RegionMetrics')
+    else:
+        discovery = discover_regions(regions, tag_name, tag_values, region_namespaces, region_metrics=region_metrics)
+        with ResourceWriter(output_file, grouping_index) as writer:
+            decoration_pipeline(discovery, writer.write, workers, max_in_flight)
+        print(f'Wrote {writer.count} resources to {output_file}')
+
+    if grouping_index:
+        grouping_index.save(grouping_index_file)
+    if region_namespaces is not None:
+        cn = open(custom_namespace_file, "w")
+        cn.write(json.dumps(region_namespaces, indent=4, default=str))
+        cn.close()
+        mi = open(metric_index_file, "w")
+        mi.write(json.dumps(region_metrics, default=str))
+        mi.close()
+    if cassette:
+        cassette.save()
 
 if __name__ == '__main__':
-    handler()
+    parser = argparse.ArgumentParser(description='Collects tagged resources into the configured ResourceFile')
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument('--record', metavar='CASSETTE', help='save every AWS response into a compressed cassette file')
+    cassette_group.add_argument('--replay', metavar='CASSETTE', help='run offline using responses from a recorded cassette file')
+    parser.add_argument('--auto-regions', action='store_true', help='probe all enabled regions and collect only the ones with tagged resources')
+    parser.add_argument('--regions', nargs='+', help='re-collect only these regions and merge them into the existing ResourceFile')
+    parser.add_argument('--services', nargs='+', choices=sorted(DECORATORS), help='re-collect only these resource types and merge them into the existing ResourceFile')
+    parser.add_argument('--arns', nargs='+', help='re-collect only these resources and merge them into the existing ResourceFile')
+    parser.add_argument('--events', metavar='FILE', help='apply resource change events from a file to the existing ResourceFile')
+    parser.add_argument('--queue-url', help='apply resource change events from an SQS queue to the existing ResourceFile')
+    parser.add_argument('--queue-region', help='region of --queue-url, defaults to the region in the URL or the configured region')
+    parser.add_argument('--follow', action='store_true', help='keep polling --queue-url for new events')
+    args = parser.parse_args()
+    handler(record_file=args.record, replay_file=args.replay, refresh_regions=args.regions,
+            refresh_services=args.services, refresh_arns=args.arns, auto_regions=args.auto_regions,
+            events_file=args.events, queue_url=args.queue_url, follow=args.follow, queue_region=args.queue_region)
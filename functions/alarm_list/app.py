@@ -1,19 +1,11 @@
 import boto3
 from boto3.dynamodb.conditions import Attr
-from datetime import datetime
+from datetime import datetime, timezone
 import math
-import json
+from alarm_config import get_config
+from view_state import get_view_key, update_view_state
 
 dynamodb = boto3.resource('dynamodb')
-ssm_client = boto3.client('ssm')
-
-
-def get_parameter_from_store(param_name):
-    response = ssm_client.get_parameter(
-        Name=param_name,
-        WithDecryption=True  # Use this if the parameter value is encrypted
-    )
-    return response['Parameter']['Value']
 
 
 def is_expression_alarm(alarm):
@@ -95,16 +87,6 @@ def paginate_items(items, current_page, page_size):
     return page_items
 
 
-def put_parameter_to_store(param_name, param_value):
-    response = ssm_client.put_parameter(
-        Name=param_name,
-        Value=param_value,
-        Type='String',
-        Overwrite=True
-    )
-    return response
-
-
 def get_account_list(alarms):
     unique_accounts = set()
     for alarm in alarms:
@@ -121,30 +103,82 @@ def get_region_list(alarms):
     return list(unique_regions)
 
 
+def get_transition_counts(config, day, top):
+    """Current transition counts of the leaderboard alarms, the leaderboard item is only written on rank changes"""
+    counts = dict(top)
+    alarm_keys = list(top)
+    for offset in range(0, len(alarm_keys), 100):
+        response = dynamodb.batch_get_item(RequestItems={
+            config['historyTableName']: {
+                'Keys': [{'alarmKey': alarm_key, 'stateTimestamp': f'#count#{day}'}
+                         for alarm_key in alarm_keys[offset:offset+100]],
+                'ProjectionExpression': 'alarmKey, transitions'
+            }
+        })
+        for item in response['Responses'][config['historyTableName']]:
+            counts[item['alarmKey']] = max(counts[item['alarmKey']], item['transitions'])
+    return counts
+
+
+def get_noisiest_alarms_html(config, context):
+    """Top alarms by transitions today, read from the leaderboard item the alarm handler keeps up to date"""
+    table = dynamodb.Table(config['historyTableName'])
+    day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    leaderboard = table.get_item(
+        Key={
+            'alarmKey': '#leaderboard',
+            'stateTimestamp': day
+        }
+    ).get('Item', {'top': {}})
+
+    html = f'''<div style="width:100%;"><p><a>All alarms</a><cwdb-action action="call"
+             endpoint="{context.invoked_function_arn}">
+             {{ "view": "all" }}
+            </cwdb-action></p></div>'''
+    html += '<table style="width:100%;">'
+    html += ('\t<thead><tr><th>#</th><th>Alarm Name</th><th>Alarm Account</th><th>Region</th>'
+             f'<th>Transitions ({day} UTC)</th></tr></thead>')
+    noisiest = sorted(get_transition_counts(config, day, leaderboard['top']).items(),
+                      key=lambda entry: entry[1], reverse=True)
+    for rank, (alarm_key, transitions) in enumerate(noisiest, start=1):
+        account_id, alarm_name = alarm_key.split('#', 1)
+        alarm_name, region = alarm_name.rsplit('#', 1)
+        html += (f'\t<tr><td>{rank}</td><td>{alarm_name}</td><td>{account_id}</td><td>{region}</td>'
+                 f'<td>{transitions}</td></tr>\n')
+    if not noisiest:
+        html += '\t<tr><td colspan="5">No alarm transitions today</td></tr>'
+    html += '</table>'
+    return html
+
+
 def lambda_handler(event, context):
     print(event)
-    config = json.loads(get_parameter_from_store('CloudWatchAlarmWidgetConfigCDK'))
+    config = get_config()
+    changes = {}
     if 'currentAlarmViewPage' in event:
-        config['currentAlarmViewPage'] = int(event['currentAlarmViewPage'])
+        changes['currentAlarmViewPage'] = int(event['currentAlarmViewPage'])
     if 'region' in event:
-        config['region_filter'] = event['region']
+        changes['region_filter'] = event['region']
 
     if 'sort_by_region' in event:
-        config['sort_by_region'] = event['sort_by_region']
+        changes['sort_by_region'] = event['sort_by_region']
 
     if 'account' in event:
-        config['account_filter'] = event['account']
+        changes['account_filter'] = event['account']
 
     if 'sort_by_account' in event:
-        config['sort_by_account'] = event['sort_by_account']
+        changes['sort_by_account'] = event['sort_by_account']
 
     if 'state' in event:
-        config['state_filter'] = event['state']
+        changes['state_filter'] = event['state']
 
     if 'priority' in event:
-        config['priority_filter'] = event['priority']
+        changes['priority_filter'] = event['priority']
 
-    put_parameter_to_store('CloudWatchAlarmWidgetConfigCDK', json.dumps(config))
+    if 'view' in event:
+        changes['alarm_list_view'] = event['view']
+
+    config.update(update_view_state(config['viewStateTableName'], get_view_key(event), changes))
 
     configurator_lambda_function = ""
     try:
@@ -153,6 +187,9 @@ def lambda_handler(event, context):
     except KeyError:
         print('Configurator Lambda function not found')
 
+    if config.get('alarm_list_view') == 'noisiest' and 'historyTableName' in config:
+        return get_noisiest_alarms_html(config, context)
+
     table = dynamodb.Table(config['dynamoTableName'])
     print(f'Accessing table {config["dynamoTableName"]}')
     region_filter_icon_color = "000000"
@@ -247,6 +284,11 @@ def lambda_handler(event, context):
              endpoint="{context.invoked_function_arn}">
              {{ "currentAlarmViewPage": {total_filtered_page} }}
             </cwdb-action>'''
+    if 'historyTableName' in config:
+        html += f'''&nbsp;|&nbsp;<a>Noisiest alarms</a><cwdb-action action="call"
+             endpoint="{context.invoked_function_arn}">
+             {{ "view": "noisiest" }}
+            </cwdb-action>'''
     html += '''</p></div>
     '''
     html += '<table style="width:100%;">'
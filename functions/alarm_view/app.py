@@ -1,16 +1,7 @@
 import boto3
-import json
+from alarm_config import get_config
 
 dynamodb = boto3.resource('dynamodb')
-ssm_client = boto3.client('ssm')
-
-
-def get_parameter_from_store(param_name):
-    response = ssm_client.get_parameter(
-        Name=param_name,
-        WithDecryption=True  # Use this if the parameter value is encrypted
-    )
-    return response['Parameter']['Value']
 
 
 def is_expression_alarm(alarm):
@@ -38,7 +29,7 @@ def sort_by_priority(alarms):
 
 
 def lambda_handler(event, context):
-    config = json.loads(get_parameter_from_store('CloudWatchAlarmWidgetConfigCDK'))
+    config = get_config()
     table = dynamodb.Table(config['dynamoTableName'])
     #print(f'Compact value is {compact}')
     query_params = {
@@ -0,0 +1,35 @@
+"""Configuration of the alarm dashboard functions, shared with them through a Lambda layer.
+
+The configuration lives in an SSM parameter that only changes when the stack is deployed. It is cached across warm
+invocations and reloaded when the cache expires.
+"""
+import copy
+import json
+import os
+import time
+import boto3
+
+CONFIG_PARAMETER = 'CloudWatchAlarmWidgetConfigCDK'
+# Seconds the configuration is cached at most
+CONFIG_CACHE_TTL = int(os.environ.get('CONFIG_CACHE_TTL', 300))
+
+ssm_client = boto3.client('ssm')
+
+# Lives across warm invocations of the Lambda function
+config_cache = {'config': None, 'expiresAt': 0}
+
+
+def get_parameter_from_store(param_name):
+    response = ssm_client.get_parameter(
+        Name=param_name,
+        WithDecryption=True  # Use this if the parameter value is encrypted
+    )
+    return response['Parameter']['Value']
+
+
+def get_config():
+    """The configuration, from the cache unless it expired. Callers get their own copy to modify."""
+    if config_cache['config'] is None or time.time() >= config_cache['expiresAt']:
+        config_cache.update(config=json.loads(get_parameter_from_store(CONFIG_PARAMETER)),
+                            expiresAt=time.time() + CONFIG_CACHE_TTL)
+    return copy.deepcopy(config_cache['config'])
@@ -0,0 +1,47 @@
+"""Filters and the current page of the alarm list, kept per dashboard and widget.
+
+Every dashboard widget has its own item in the view state table, so viewers of different dashboards no longer
+overwrite each other's filters, and the item is only written when a filter or the page actually changes.
+"""
+import boto3
+from botocore.exceptions import ClientError
+
+dynamodb = boto3.resource('dynamodb')
+
+
+def get_view_key(event):
+    """Dashboard and widget the custom widget was invoked from"""
+    widget_context = event.get('widgetContext', {})
+    return f"{widget_context.get('dashboardName', 'default')}#{widget_context.get('widgetId', 'default')}"
+
+
+def update_view_state(table_name, view_key, changes):
+    """Applies the changes to the stored view state and returns it. Writes are conditional on the version read, a
+    concurrent change is read again and the changes are applied on top of it.
+    """
+    table = dynamodb.Table(table_name)
+    for attempt in range(3):
+        item = table.get_item(
+            Key={
+                'viewKey': view_key
+            }
+        ).get('Item', {'state': {}, 'version': 0})
+        state = {**item['state'], **changes}
+        if state == item['state']:
+            return state
+        try:
+            table.put_item(
+                Item={
+                    'viewKey': view_key,
+                    'state': state,
+                    'version': item['version'] + 1
+                },
+                ConditionExpression='attribute_not_exists(version) OR version = :version',
+                ExpressionAttributeValues={':version': item['version']}
+            )
+            return state
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    print(f'ERROR: Could not store the view state of {view_key}, too many concurrent changes')
+    return state
@@ -1,25 +1,6 @@
 import boto3
-import json
-
-ssm_client = boto3.client('ssm')
-
-
-def get_parameter_from_store(param_name):
-    response = ssm_client.get_parameter(
-        Name=param_name,
-        WithDecryption=True  # Use this if the parameter value is encrypted
-    )
-    return response['Parameter']['Value']
-
-
-def put_parameter_to_store(param_name, param_value):
-    response = ssm_client.put_parameter(
-        Name=param_name,
-        Value=param_value,
-        Type='String',
-        Overwrite=True
-    )
-    return response
+from alarm_config import get_config
+from view_state import get_view_key, update_view_state
 
 
 def handle_suppression_request(event, config):
@@ -46,38 +27,39 @@ def lambda_handler(event, context):
     print(event)
     print(context)
     message = "Configuration applied:"
-    config = json.loads(get_parameter_from_store('CloudWatchAlarmWidgetConfigCDK'))
+    config = get_config()
+    changes = {}
     if 'region' in event:
-        config['region_filter'] = event['region']
+        changes['region_filter'] = event['region']
         message += f" region_filter={event['region']}"
 
     if 'sort_by_region' in event:
-        config['sort_by_region'] = event['sort_by_region']
+        changes['sort_by_region'] = event['sort_by_region']
         message += f" sort_by_region={event['sort_by_region']}"
 
     if 'account' in event:
-        config['account_filter'] = event['account']
+        changes['account_filter'] = event['account']
         message += f" account_filter={event['account']}"
 
     if 'sort_by_account' in event:
-        config['sort_by_account'] = event['sort_by_account']
+        changes['sort_by_account'] = event['sort_by_account']
         message += f" sort_by_account={event['sort_by_account']}"
 
     if 'state' in event:
-        config['state_filter'] = event['state']
+        changes['state_filter'] = event['state']
         message += f" state_filter={event['state']}"
 
     if 'priority' in event:
-        config['priority_filter'] = event['priority']
+        changes['priority_filter'] = event['priority']
         message += f" priority_filter={event['priority']}"
 
     if 'suppress' in event:
         return handle_suppression_request(event,config)
 
     if 'currentAlarmViewPage' in event:
-        config['currentAlarmViewPage'] = int(event['currentAlarmViewPage'])
-
+        changes['currentAlarmViewPage'] = int(event['currentAlarmViewPage'])
 
+    config.update(update_view_state(config['viewStateTableName'], get_view_key(event), changes))
 
     message += f", current config:"
     if 'region_filter' in config:
@@ -93,5 +75,4 @@ def lambda_handler(event, context):
     if 'priority_filter' in config:
         message += f" priority_filter={config['priority_filter']}"
 
-    put_parameter_to_store('CloudWatchAlarmWidgetConfigCDK', json.dumps(config))
     return message
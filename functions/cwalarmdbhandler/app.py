@@ -1,19 +1,108 @@
 import json
+import math
+import threading
+import time
 import boto3
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import nullcontext
+from functools import partial
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 from botocore.exceptions import ClientError
 from botocore.config import Config
+from alarm_config import get_config
+from history import COUNTER_PREFIX, LEADERBOARD_KEY, history_item
 
-# Dodo fix assume role distribution
-dynamodb = boto3.resource('dynamodb')
-ssm_client = boto3.client('ssm')
 
+class ExpiringCache:
+    """Cache of (expiry epoch, value) entries that live across warm invocations. Expired entries are dropped when
+    they are read and the least recently used entries beyond max_size are evicted, so the cache can't grow without
+    bound in a long lived container.
+    """
 
-def get_parameter_from_store(param_name):
-    response = ssm_client.get_parameter(
-        Name=param_name,
-        WithDecryption=True  # Use this if the parameter value is encrypted
-    )
-    return response['Parameter']['Value']
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def __setitem__(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# The default boto3 session isn't thread safe, clients and resources are only created from it under this lock
+session_lock = threading.Lock()
+# boto3 resources aren't thread safe either, every thread uses its own DynamoDB resource and tables
+thread_resources = threading.local()
+
+# Caches below live across warm invocations of the Lambda function
+current_account_id = None
+# (account, region) -> assumed role credentials
+credential_cache = {}
+# Guards credential_locks, STS is called under the lock of the (account, region) only so that a slow or throttled
+# AssumeRole doesn't hold up the other accounts
+credential_lock = threading.Lock()
+credential_locks = {}
+# Assumed role credentials are refreshed this long before they expire
+CREDENTIAL_REFRESH_MARGIN = timedelta(minutes=5)
+# (account, region, service) -> (client, access key id of the credentials the client was created with)
+client_pool = {}
+client_pool_lock = threading.Lock()
+# (account, kind) -> (expiry epoch, account metadata)
+account_cache = ExpiringCache(max_size=20000)
+# (account, region, instance id) -> (expiry epoch, instance), shared by the alarms of an alarm storm
+instance_cache = ExpiringCache(max_size=10000)
+INSTANCE_CACHE_TTL = 60
+# alarm arn -> (expiry epoch, alarm tags), the stored alarm is checked first as tag change events update it
+alarm_tag_cache = ExpiringCache(max_size=10000)
+alarm_tag_cache_settings = {'ttl': 3600}
+# Set from the widget configuration on every invocation, table is the optional shared tier
+account_cache_settings = {'ttl': 86400, 'table': None}
+# Seconds accounts without the metadata (no alternate contact, not found) are cached at most
+ACCOUNT_CACHE_NEGATIVE_TTL = 3600
+# Enrichment lookups of an event run concurrently, see augment_event
+enrichment_executor = ThreadPoolExecutor(max_workers=8)
+# Seconds augment_event waits for enrichment lookups
+ENRICHMENT_TIMEOUT = 10
+# Set from the widget configuration on every invocation, clients time out so that lookups end with the enrichment
+client_settings = {'timeout': ENRICHMENT_TIMEOUT}
+# Alarms of an SQS batch that are enriched and stored concurrently
+BATCH_WORKERS = 4
+# Set from the widget configuration, a threshold of 0 disables flap detection
+flap_settings = {'window': 3600, 'threshold': 0}
+# Set from the widget configuration, transitions are only recorded when the history table is configured
+history_settings = {'table': None, 'retention': 90, 'leaderboardSize': 20}
+# Parallel scan segments of the sweep of deleted alarms and instances
+SWEEP_SEGMENTS = 4
+# Key of the item that keeps the position of every scan segment of a sweep that ran out of time
+SWEEP_STATE_KEY = '#sweep'
+# day -> last read or written leaderboard item, counts only grow within a day so a stale copy never hides an entry
+leaderboard_cache = {}
+cache_stats = {
+    'credentials': {'hits': 0, 'misses': 0},
+    'clients': {'hits': 0, 'misses': 0},
+    'accounts': {'hits': 0, 'misses': 0},
+    'instances': {'hits': 0, 'misses': 0},
+    'alarmTags': {'hits': 0, 'misses': 0}
+}
 
 
 def is_expression_alarm(alarm):
@@ -33,35 +122,123 @@ def get_alarm_type(alarm):
         return "standard"
 
 
-def get_client(service, event_account_id, region):
-    # Get the current AWS account ID
-    boto_config = Config(
-        region_name=region
+def count_cache(cache, hit):
+    cache_stats[cache]['hits' if hit else 'misses'] += 1
+
+
+def new_client(service, **kwargs):
+    with session_lock:
+        return boto3.client(service, **kwargs)
+
+
+def client_config(region):
+    """Connect and read timeouts that let a lookup with one retry finish within the enrichment timeout"""
+    attempt_timeout = max(client_settings['timeout'] / 4, 1)
+    return Config(
+        region_name=region,
+        connect_timeout=attempt_timeout,
+        read_timeout=attempt_timeout,
+        retries={'total_max_attempts': 2, 'mode': 'standard'}
     )
-    sts_client = boto3.client('sts', config=boto_config)
-    current_account_id = sts_client.get_caller_identity()['Account']
 
+
+def get_dynamodb():
+    """DynamoDB resource of the calling thread"""
+    if not hasattr(thread_resources, 'dynamodb'):
+        with session_lock:
+            thread_resources.dynamodb = boto3.resource('dynamodb')
+    return thread_resources.dynamodb
+
+
+def get_table(table_name):
+    tables = thread_resources.__dict__.setdefault('tables', {})
+    if table_name not in tables:
+        tables[table_name] = get_dynamodb().Table(table_name)
+    return tables[table_name]
+
+
+class ThreadLocalTable:
+    """DynamoDB table that can be shared by threads, every call goes to the Table of the calling thread"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(get_table(self.name), attribute)
+
+
+def get_credential_lock(key):
+    with credential_lock:
+        return credential_locks.setdefault(key, threading.Lock())
+
+
+def get_current_account_id():
+    global current_account_id
+    if current_account_id is None:
+        with get_credential_lock('current'):
+            if current_account_id is None:
+                current_account_id = new_client('sts').get_caller_identity()['Account']
+    return current_account_id
+
+
+def get_credentials(event_account_id, region):
+    """Assumed role credentials for the source account, reused until shortly before they expire"""
+    with get_credential_lock((event_account_id, region)):
+        return get_cached_credentials(event_account_id, region)
+
+
+def get_cached_credentials(event_account_id, region):
+    credentials = credential_cache.get((event_account_id, region))
+    if credentials and credentials['Expiration'] - CREDENTIAL_REFRESH_MARGIN > datetime.now(timezone.utc):
+        count_cache('credentials', True)
+        return credentials
+
+    count_cache('credentials', False)
+    print('Assuming cross account role')
+    sts_client = new_client('sts', config=client_config(region))
+    target_role = f'arn:aws:iam::{event_account_id}:role/CrossAccountAlarmAugmentationAssumeRole-{region}'
+    assumed_role_object = sts_client.assume_role(
+        RoleArn=target_role,
+        RoleSessionName="AssumeRoleSession1"
+    )
+    credentials = assumed_role_object['Credentials']
+    credential_cache[(event_account_id, region)] = credentials
+    return credentials
+
+
+def get_client(service, event_account_id, region):
+    """Clients are pooled per account, region and service and recreated when the assumed role credentials rotate"""
     # Use local execution role for monitoring account and assumed role for source accounts
-    if current_account_id == event_account_id:
-        # Use the default boto3 client for the current account
-        print('Not assuming cross account role')
-        return boto3.client(service, config=boto_config)
+    if get_current_account_id() == event_account_id:
+        credentials = None
+        access_key_id = None
     else:
-        # Assume the role in the event account
-        print('Assuming cross account role')
-        target_role = f'arn:aws:iam::{event_account_id}:role/CrossAccountAlarmAugmentationAssumeRole-{region}'
-        assumed_role_object = sts_client.assume_role(
-            RoleArn=target_role,
-            RoleSessionName="AssumeRoleSession1"
-        )
+        credentials = get_credentials(event_account_id, region)
+        access_key_id = credentials['AccessKeyId']
 
-        return boto3.client(
-            service,
-            aws_access_key_id=assumed_role_object['Credentials']['AccessKeyId'],
-            aws_secret_access_key=assumed_role_object['Credentials']['SecretAccessKey'],
-            aws_session_token=assumed_role_object['Credentials']['SessionToken'],
-            config=boto_config
-        )
+    key = (event_account_id, region, service)
+    with client_pool_lock:
+        pooled = client_pool.get(key)
+        if pooled and pooled[1] == access_key_id and pooled[2] == client_settings['timeout']:
+            count_cache('clients', True)
+            return pooled[0]
+
+        count_cache('clients', False)
+        boto_config = client_config(region)
+        if credentials is None:
+            # Use the default boto3 client for the current account
+            print('Not assuming cross account role')
+            client = new_client(service, config=boto_config)
+        else:
+            client = new_client(
+                service,
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'],
+                config=boto_config
+            )
+        client_pool[key] = (client, access_key_id, client_settings['timeout'])
+        return client
 
 
 def get_resource_type(metrics):
@@ -84,6 +261,60 @@ def get_alarm_tags(alarm_arn, account_id, region):
     return response['Tags']
 
 
+def get_cached_alarm_tags(alarm_arn, account_id, region, stored=None):
+    """Alarm tags and their expiry from the stored alarm, the in-memory cache or the API"""
+    now = time.time()
+    if stored and 'alarmTags' in stored and stored.get('alarmTagsExpiresAt', 0) > now:
+        count_cache('alarmTags', True)
+        return stored['alarmTags'], int(stored['alarmTagsExpiresAt'])
+    cached = alarm_tag_cache.get(alarm_arn)
+    if cached and cached[0] > now:
+        count_cache('alarmTags', True)
+        return cached[1], cached[0]
+
+    count_cache('alarmTags', False)
+    alarm_tags = get_alarm_tags(alarm_arn, account_id, region)
+    expires_at = int(now + alarm_tag_cache_settings['ttl'])
+    alarm_tag_cache[alarm_arn] = (expires_at, alarm_tags)
+    return alarm_tags, expires_at
+
+
+def is_tag_change_event(event):
+    return event.get('detail-type') == 'Tag Change on Resource'
+
+
+def process_tag_change(event, table):
+    """Tag change events carry all current tags of the alarm. They replace the cached tags and the stored priority
+    of alarms that are already stored.
+    """
+    alarm_arn = event['resources'][0]
+    alarm_tags = [{'Key': key, 'Value': value} for key, value in event['detail'].get('tags', {}).items()]
+    expires_at = int(time.time() + alarm_tag_cache_settings['ttl'])
+    alarm_tag_cache[alarm_arn] = (expires_at, alarm_tags)
+
+    arn_parts = alarm_arn.split(':')
+    alarm_key = f"{arn_parts[4]}#{alarm_arn.split(':alarm:')[1]}#{arn_parts[3]}"
+    try:
+        table.update_item(
+            Key={
+                'alarmKey': alarm_key
+            },
+            UpdateExpression='SET alarmTags = :alarm_tags, priority = :priority, alarmTagsExpiresAt = :expires_at',
+            ConditionExpression='attribute_exists(alarmKey)',
+            ExpressionAttributeValues={
+                ':alarm_tags': alarm_tags,
+                ':priority': get_priority(alarm_tags),
+                ':expires_at': expires_at
+            }
+        )
+        print(f'Updated tags of {alarm_key}')
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print(f'Not updating tags of {alarm_key}, the alarm is not stored yet')
+    return 'Stored'
+
+
 def get_priority(alarm_tags):
     priority = 2
     for tag in alarm_tags:
@@ -109,37 +340,129 @@ def get_priority(alarm_tags):
     return priority
 
 
+def account_cache_key(account_id, kind):
+    """Shared account cache items live in the alarm table under keys that can't collide with alarm keys"""
+    return f'#account#{kind}#{account_id}'
+
+
+def get_cached_account_metadata(account_id, kind, lookup):
+    """Account metadata changes rarely. Lookups are cached in memory and, when the shared tier is enabled, in the
+    alarm table so that all handler instances benefit. Empty results, when the account has no such metadata, are cached
+    for at most ACCOUNT_CACHE_NEGATIVE_TTL. Failed lookups raise and aren't cached.
+    """
+    now = time.time()
+    cached = account_cache.get((account_id, kind))
+    if cached and cached[0] > now:
+        count_cache('accounts', True)
+        return cached[1]
+
+    table = account_cache_settings['table']
+    if table is not None:
+        item = table.get_item(Key={'alarmKey': account_cache_key(account_id, kind)}).get('Item')
+        if item and item['expiresAt'] > now:
+            count_cache('accounts', True)
+            account_cache[(account_id, kind)] = (int(item['expiresAt']), item['metadata'])
+            return item['metadata']
+
+    count_cache('accounts', False)
+    metadata = lookup()
+    ttl = account_cache_settings['ttl'] if metadata else min(account_cache_settings['ttl'], ACCOUNT_CACHE_NEGATIVE_TTL)
+    put_cached_account_metadata(account_id, kind, metadata, now + ttl)
+    return metadata
+
+
+def put_cached_account_metadata(account_id, kind, metadata, expires_at, batch=None):
+    account_cache[(account_id, kind)] = (expires_at, metadata)
+    table = batch or account_cache_settings['table']
+    if table is not None:
+        table.put_item(Item={
+            'alarmKey': account_cache_key(account_id, kind),
+            'metadata': metadata,
+            'expiresAt': int(expires_at)
+        })
+
+
+def warm_account_cache(region):
+    """Fills the account info cache for every account of the organization from one paginated list_accounts call"""
+    organizations_client = get_client('organizations', get_current_account_id(), region)
+    expires_at = time.time() + account_cache_settings['ttl']
+    count = 0
+    table = account_cache_settings['table']
+    with table.batch_writer() if table is not None else nullcontext() as batch:
+        for page in organizations_client.get_paginator('list_accounts').paginate():
+            for account in page['Accounts']:
+                account.pop('JoinedTimestamp', None)
+                put_cached_account_metadata(account['Id'], 'Account', account, expires_at, batch)
+                count += 1
+    print(f'Warmed account cache with {count} accounts')
+    return count
+
+
 def get_alternate_contact(account_id, region):
+    return get_cached_account_metadata(account_id, 'AlternateContact',
+                                       lambda: lookup_alternate_contact(account_id, region))
+
+
+def lookup_alternate_contact(account_id, region):
+    """The operations contact, {} when the account has none. Other errors, such as throttling, are raised."""
     acct_client = get_client('account', account_id, region)
     try:
         result = acct_client.get_alternate_contact(
             AlternateContactType='OPERATIONS'
         )
         return result['AlternateContact']
-    except Exception as e:
-        print(e)
-        print('ERROR: No alternate contact found')
+    except acct_client.exceptions.ResourceNotFoundException:
+        print(f'No alternate contact found for {account_id}')
         return {}
 
 
 def get_ec2_instance_info(account_id, instance_id, region):
+    cached = instance_cache.get((account_id, region, instance_id))
+    if cached and cached[0] > time.time():
+        count_cache('instances', True)
+        return cached[1]
+
+    count_cache('instances', False)
     print(f'Getting info for {instance_id}')
-    ec2_client = get_client('ec2', account_id, region)
     try:
-        response = ec2_client.describe_instances(
-            InstanceIds=[
-                instance_id
-            ]
-        )
-        return response['Reservations'][0]['Instances'][0]
+        return describe_instances(account_id, region, [instance_id]).get(instance_id, {})
     except Exception as e:
         print(e)
         print('ERROR: No instance info found')
         return {}
 
 
+def describe_instances(account_id, region, instance_ids):
+    """Resolves the instances of one account and region with multi-id describe_instances calls and caches them
+    briefly for the other alarms of the same storm. The instance-id filter, unlike InstanceIds, doesn't fail the call
+    when some of the instances no longer exist.
+    """
+    ec2_client = get_client('ec2', account_id, region)
+    instances = {}
+    for offset in range(0, len(instance_ids), 200):
+        for page in ec2_client.get_paginator('describe_instances').paginate(
+                Filters=[
+                    {
+                        'Name': 'instance-id',
+                        'Values': instance_ids[offset:offset+200]
+                    }
+                ]):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instances[instance['InstanceId']] = instance
+
+    expires_at = time.time() + INSTANCE_CACHE_TTL
+    for instance_id in instance_ids:
+        instance_cache[(account_id, region, instance_id)] = (expires_at, instances.get(instance_id, {}))
+    return instances
+
+
 def get_account_info(account_id, region):
+    return get_cached_account_metadata(account_id, 'Account', lambda: lookup_account_info(account_id, region))
+
 
+def lookup_account_info(account_id, region):
+    """The account of the organization, {} when it isn't found. Other errors, such as throttling, are raised."""
     organizations_client = get_client('organizations', account_id, region)
     try:
         result = organizations_client.describe_account(
@@ -148,13 +471,49 @@ def get_account_info(account_id, region):
         if 'JoinedTimestamp' in result['Account']:
             del result['Account']['JoinedTimestamp']
         return result['Account']
-    except Exception as e:
-        print(e)
-        print('ERROR: No account info found')
+    except organizations_client.exceptions.AccountNotFoundException:
+        print(f'No account info found for {account_id}')
         return {}
 
 
-def augment_event(event):
+def get_instance_id(event):
+    """InstanceId dimension of standard EC2 alarms, None for other alarms"""
+    if get_alarm_type(event) != "standard":
+        return None
+    if get_resource_type(event['detail']['configuration']['metrics']) != 'ec2_instance':
+        print('Not augmenting resource that is not yet implemented!')
+        return None
+    instance_id = ''
+    for metric in event["detail"]["configuration"]["metrics"]:
+        if "metricStat" in metric:
+            for dimension in list(metric["metricStat"]["metric"]["dimensions"].keys()):
+                if dimension == 'InstanceId':
+                    instance_id = metric["metricStat"]["metric"]["dimensions"][dimension]
+        else:
+            print('Ignoring metric')
+    return instance_id
+
+
+def run_lookups(lookups, timeout):
+    """Runs the independent enrichment lookups concurrently. Lookups that fail or don't finish within timeout seconds
+    are left out of the result so that the event is stored with partial enrichment. Lookups that haven't started are
+    cancelled, running ones end with the timeouts of their clients.
+    """
+    futures = {enrichment_executor.submit(lookup): name for name, lookup in lookups.items()}
+    done, not_done = wait(futures, timeout=timeout)
+    results = {}
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except Exception as e:
+            print(f'ERROR: {futures[future]} lookup failed: {e}')
+    for future in not_done:
+        future.cancel()
+        print(f'ERROR: {futures[future]} lookup did not finish within {timeout:.1f} seconds')
+    return results
+
+
+def augment_event(event, timeout=ENRICHMENT_TIMEOUT, stored=None):
     payload = event
     region = event['region']
     payload['AlarmName'] = event['detail']['alarmName']
@@ -163,69 +522,121 @@ def augment_event(event):
     payload['Account'] = account_id
     alarm_arn = event['resources'][0]
 
-    payload['AlarmTags'] = get_alarm_tags(alarm_arn, account_id, region)
-    payload['Priority'] = get_priority(payload['AlarmTags'])
+    lookups = {
+        'AlarmTags': lambda: get_cached_alarm_tags(alarm_arn, account_id, region, stored),
+        'AlternateContact': lambda: get_alternate_contact(account_id, region),
+        'Account': lambda: get_account_info(account_id, region)
+    }
+    instance_id = get_instance_id(event)
+    if instance_id is not None:
+        lookups['InstanceInfo'] = lambda: get_ec2_instance_info(account_id, instance_id, region)
+    results = run_lookups(lookups, timeout)
 
+    # Without tags the stored tags and priority are kept
+    if 'AlarmTags' in results:
+        payload['AlarmTags'], payload['AlarmTagsExpiresAt'] = results['AlarmTags']
+        payload['Priority'] = get_priority(payload['AlarmTags'])
+
+    # Without a lookup result the stored contact and account are kept
+    stored_auxiliary_info = (stored or {}).get('auxiliaryInfo', {})
     payload['AuxiliaryInfo'] = {}
-    payload['AuxiliaryInfo']['AlternateContact'] = get_alternate_contact(account_id, region)
-
-    payload['AuxiliaryInfo']['Account'] = get_account_info(account_id, region)
-
-    if get_alarm_type(event) == "standard":
-        if get_resource_type(event['detail']['configuration']['metrics']) == 'ec2_instance':
-            instance_id = ''
-            for metric in event["detail"]["configuration"]["metrics"]:
-                if "metricStat" in metric:
-                    for dimension in list(metric["metricStat"]["metric"]["dimensions"].keys()):
-                        if dimension == 'InstanceId':
-                            instance_id = metric["metricStat"]["metric"]["dimensions"][dimension]
-                else:
-                    print('Ignoring metric')
-            try:
-                instance_info = get_ec2_instance_info(account_id, instance_id, region)
-                if len(instance_info) == 0:
-                    payload['InstanceInfo'] = {'Error': 'Instance not found'}
-                else:
-                    payload['InstanceInfo'] = instance_info
-            except ClientError as error:
-                print('Error happened: {}'.format(error))
+    payload['AuxiliaryInfo']['AlternateContact'] = results.get('AlternateContact',
+                                                               stored_auxiliary_info.get('AlternateContact', {}))
+
+    payload['AuxiliaryInfo']['Account'] = results.get('Account', stored_auxiliary_info.get('Account', {}))
 
+    if 'InstanceInfo' in results:
+        if len(results['InstanceInfo']) == 0:
+            payload['InstanceInfo'] = {'Error': 'Instance not found'}
         else:
-            print('Not augmenting resource that is not yet implemented!')
+            payload['InstanceInfo'] = results['InstanceInfo']
 
     if payload['AuxiliaryInfo']['Account'] == {}:
-        payload['AuxiliaryInfo']['Account']['Id'] = account_id
+        payload['AuxiliaryInfo']['Account'] = {'Id': account_id}
 
     return payload
 
 
-def lambda_handler(event, context):
-    config = json.loads(get_parameter_from_store('CloudWatchAlarmWidgetConfigCDK'))
-    table = dynamodb.Table(config['dynamoTableName'])
+def get_alarm_key(event):
+    return f"{event['account']}#{event['detail']['alarmName']}#{event['region']}"
 
-    event['AuxiliaryInfo'] = {}
 
-    event = augment_event(event)
+def project(source, fields):
+    return {field: source[field] for field in fields if field in source}
 
-    event['AuxiliaryInfo']['Suppressed'] = 0
 
-    region = event['region']
-    alarm_key = f"{event['account']}#{event['detail']['alarmName']}#{region}"
+def compact_metric(metric):
+    compact = project(metric, ('id', 'expression', 'label'))
+    if 'metricStat' in metric:
+        compact['metricStat'] = {'metric': project(metric['metricStat']['metric'], ('namespace', 'name', 'dimensions'))}
+    return compact
+
+
+def compact_detail(detail):
+    """The parts of the event detail that alarm_list and alarm_view render"""
+    compact = {
+        'alarmName': detail['alarmName'],
+        'state': project(detail['state'], ('value', 'timestamp', 'reason')),
+        'configuration': {}
+    }
+    configuration = detail.get('configuration', {})
+    if 'metrics' in configuration:
+        compact['configuration']['metrics'] = [compact_metric(metric) for metric in configuration['metrics']]
+    if 'alarmRule' in configuration:
+        compact['configuration']['alarmRule'] = configuration['alarmRule']
+    return compact
+
+
+def compact_auxiliary_info(auxiliary_info):
+    compact = project(auxiliary_info, ('Suppressed',))
+    if 'AlternateContact' in auxiliary_info:
+        compact['AlternateContact'] = project(auxiliary_info['AlternateContact'],
+                                              ('Name', 'Title', 'PhoneNumber', 'EmailAddress'))
+    if 'Account' in auxiliary_info:
+        compact['Account'] = project(auxiliary_info['Account'], ('Id', 'Status', 'Email'))
+    return compact
+
+
+def compact_instance_info(instance_info):
+    return project(instance_info, ('Error', 'InstanceId', 'InstanceType', 'ImageId', 'Tags'))
+
+
+def get_alarm_update_params(event, compact=True):
+    """Conditional update of the alarm item that never overwrites a newer state. The compact schema keeps only the
+    fields the widgets render instead of the full event and lookups, and adds accountId and region attributes.
+    """
+    alarm_key = get_alarm_key(event)
 
     state_value = event['detail']['state']['value']
     update_expression = ("SET stateValue = :state_value, "
                          "suppressed = if_not_exists(suppressed, :suppressed), "
-                         "detail = :detail, auxiliaryInfo = :auxiliary")
+                         "detail = :detail, auxiliaryInfo = :auxiliary, "
+                         "stateTimestamp = :state_timestamp, lastEventId = :event_id")
     expression_attribute_values = {
                 ':state_value': state_value,
                 ':suppressed': 0,
                 ':detail': event['detail'],
-                ':auxiliary': event['AuxiliaryInfo']
+                ':auxiliary': event['AuxiliaryInfo'],
+                ':state_timestamp': event['detail']['state']['timestamp'],
+                ':event_id': event.get('id', '')
             }
+    expression_attribute_names = {}
 
-    if 'InstanceInfo' in event['detail']:
+    if 'InstanceInfo' in event:
         update_expression += ', instanceInfo = :instance_info'
-        expression_attribute_values[':instance_info'] = event['detail']['InstanceInfo']
+        # describe_instances returns timestamps and DynamoDB requires decimals
+        expression_attribute_values[':instance_info'] = json.loads(json.dumps(event['InstanceInfo'], default=str),
+                                                                    parse_float=Decimal)
+
+    if compact:
+        expression_attribute_values[':detail'] = compact_detail(event['detail'])
+        expression_attribute_values[':auxiliary'] = compact_auxiliary_info(event['AuxiliaryInfo'])
+        if 'InstanceInfo' in event:
+            expression_attribute_values[':instance_info'] = compact_instance_info(event['InstanceInfo'])
+        update_expression += ', accountId = :account_id, #region = :region'
+        expression_attribute_values[':account_id'] = event['account']
+        expression_attribute_values[':region'] = event['region']
+        expression_attribute_names['#region'] = 'region'
 
     if 'AlarmTags' in event:
         update_expression += ', alarmTags = :alarm_tags'
@@ -235,13 +646,733 @@ def lambda_handler(event, context):
         update_expression += ', priority = :priority'
         expression_attribute_values[':priority'] = event['Priority']
 
-    response = table.update_item(
-        Key={
+    if 'AlarmTagsExpiresAt' in event:
+        update_expression += ', alarmTagsExpiresAt = :alarm_tags_expires_at'
+        expression_attribute_values[':alarm_tags_expires_at'] = event['AlarmTagsExpiresAt']
+
+    if 'RecentTransitions' in event:
+        update_expression += ', recentTransitions = :recent_transitions, flapping = :flapping, flapCount = :zero'
+        expression_attribute_values[':recent_transitions'] = event['RecentTransitions']
+        expression_attribute_values[':flapping'] = False
+        expression_attribute_values[':zero'] = 0
+
+    update_params = {
+        'Key': {
             'alarmKey': alarm_key
         },
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_attribute_values,
-        ReturnValues="ALL_NEW"
-    )
+        'UpdateExpression': update_expression,
+        # A newer state may have been stored while the event was enriched
+        'ConditionExpression': 'attribute_not_exists(stateTimestamp) OR stateTimestamp < :state_timestamp',
+        'ExpressionAttributeValues': expression_attribute_values,
+        'ReturnValues': "ALL_NEW"
+    }
+    if expression_attribute_names:
+        update_params['ExpressionAttributeNames'] = expression_attribute_names
+    return update_params
+
+
+def store_alarm_event(table, event, compact=True):
+    """Stores the alarm, see get_alarm_update_params"""
+    alarm_key = get_alarm_key(event)
+    try:
+        response = table.update_item(**get_alarm_update_params(event, compact))
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print(f'Not storing {alarm_key}, a newer state is already stored')
+            return 'Stale'
+        raise
 
     print(f"DynamoDB Response: {response}")
+    return 'Stored'
+
+
+def migrate_compact_schema(table, start_key=None, context=None):
+    """Rewrites stored alarms in the compact schema. When the Lambda function is about to time out the scan stops and
+    the returned startKey continues the migration in the next invocation.
+    """
+    scan_params = {}
+    if start_key:
+        scan_params['ExclusiveStartKey'] = start_key
+    migrated = 0
+    while True:
+        response = table.scan(**scan_params)
+        for item in response.get('Items', []):
+            # Keys starting with # aren't alarms, alarms with accountId are stored in the compact schema
+            if item['alarmKey'].startswith('#') or 'detail' not in item or 'accountId' in item:
+                continue
+            account_id, alarm_name, region = item['alarmKey'].split('#')
+            update_expression = 'SET detail = :detail, accountId = :account_id, #region = :region'
+            expression_attribute_values = {
+                ':detail': compact_detail(item['detail']),
+                ':account_id': account_id,
+                ':region': region
+            }
+            if 'auxiliaryInfo' in item:
+                update_expression += ', auxiliaryInfo = :auxiliary'
+                expression_attribute_values[':auxiliary'] = compact_auxiliary_info(item['auxiliaryInfo'])
+            if 'instanceInfo' in item:
+                update_expression += ', instanceInfo = :instance_info'
+                expression_attribute_values[':instance_info'] = compact_instance_info(item['instanceInfo'])
+            # Skip alarms that were updated since they were read
+            condition_expression = 'attribute_not_exists(stateTimestamp)'
+            if 'stateTimestamp' in item:
+                condition_expression = 'stateTimestamp = :state_timestamp'
+                expression_attribute_values[':state_timestamp'] = item['stateTimestamp']
+            try:
+                table.update_item(
+                    Key={
+                        'alarmKey': item['alarmKey']
+                    },
+                    UpdateExpression=update_expression,
+                    ConditionExpression=condition_expression,
+                    ExpressionAttributeValues=expression_attribute_values,
+                    ExpressionAttributeNames={'#region': 'region'}
+                )
+                migrated += 1
+            except ClientError as error:
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+        if 'LastEvaluatedKey' not in response:
+            print(f'Migrated {migrated} alarms, migration complete')
+            return {'migrated': migrated}
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        if context is not None and context.get_remaining_time_in_millis() < 10000:
+            print(f'Migrated {migrated} alarms, continue with startKey {response["LastEvaluatedKey"]}')
+            return {'migrated': migrated, 'startKey': response['LastEvaluatedKey']}
+
+
+def format_state_timestamp(moment):
+    """State timestamps in the format of the alarm state change events"""
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:23] + '+0000'
+
+
+def describe_alarm_event(alarm, account_id, region):
+    """Alarm state change event of the current state of an alarm returned by describe_alarms"""
+    if 'AlarmRule' in alarm:
+        configuration = {'alarmRule': alarm['AlarmRule']}
+    elif 'Metrics' in alarm:
+        configuration = {'metrics': []}
+        for query in alarm['Metrics']:
+            metric = {key[0].lower() + key[1:]: value for key, value in query.items()
+                      if key in ('Id', 'Expression', 'Label', 'ReturnData')}
+            if 'MetricStat' in query:
+                metric['metricStat'] = {
+                    'metric': {
+                        'namespace': query['MetricStat']['Metric'].get('Namespace', ''),
+                        'name': query['MetricStat']['Metric'].get('MetricName', ''),
+                        'dimensions': {dimension['Name']: dimension['Value']
+                                       for dimension in query['MetricStat']['Metric'].get('Dimensions', [])}
+                    },
+                    'period': query['MetricStat']['Period'],
+                    'stat': query['MetricStat']['Stat']
+                }
+            configuration['metrics'].append(metric)
+    else:
+        configuration = {'metrics': [{
+            'id': 'm1',
+            'metricStat': {
+                'metric': {
+                    'namespace': alarm.get('Namespace', ''),
+                    'name': alarm.get('MetricName', ''),
+                    'dimensions': {dimension['Name']: dimension['Value'] for dimension in alarm.get('Dimensions', [])}
+                },
+                'period': alarm.get('Period', 0),
+                'stat': alarm.get('Statistic', alarm.get('ExtendedStatistic', ''))
+            },
+            'returnData': True
+        }]}
+    if alarm.get('AlarmDescription'):
+        configuration['description'] = alarm['AlarmDescription']
+
+    state_timestamp = format_state_timestamp(alarm['StateUpdatedTimestamp'])
+    return {
+        'id': f'backfill-{state_timestamp}',
+        'detail-type': 'CloudWatch Alarm State Change',
+        'source': 'aws.cloudwatch',
+        'account': account_id,
+        'region': region,
+        'time': state_timestamp,
+        'resources': [alarm['AlarmArn']],
+        'detail': {
+            'alarmName': alarm['AlarmName'],
+            'state': {
+                'value': alarm['StateValue'],
+                'reason': alarm.get('StateReason', ''),
+                'timestamp': state_timestamp
+            },
+            'configuration': configuration
+        }
+    }
+
+
+def get_stored_timestamps(table, alarm_keys):
+    """alarmKey -> stateTimestamp of the stored alarms, read with BatchGetItem"""
+    stored = {}
+    for offset in range(0, len(alarm_keys), 100):
+        request = {table.name: {
+            'Keys': [{'alarmKey': alarm_key} for alarm_key in alarm_keys[offset:offset+100]],
+            'ProjectionExpression': 'alarmKey, stateTimestamp'
+        }}
+        while request:
+            response = get_dynamodb().batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(table.name, []):
+                stored[item['alarmKey']] = item.get('stateTimestamp', '')
+            request = response.get('UnprocessedKeys')
+    return stored
+
+
+def write_alarms(table, update_params):
+    """Writes the conditional alarm updates one by one, alarms whose condition fails are skipped. Transactions would
+    keep the conditions too but cost twice the write capacity that the backfill rate counts. Returns the number of
+    alarms written.
+    """
+    written = 0
+    for params in update_params:
+        try:
+            table.update_item(**params)
+            written += 1
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    return written
+
+
+def backfill_alarms(table, account_id, region, compact=True, context=None, next_token=None, writes_per_second=100):
+    """Stores the current state of every alarm of one account and region that isn't stored yet or is stored with an
+    older state, so that a new deployment doesn't start with an empty dashboard. Pages of 100 alarms are enriched
+    like alarm events, with the instances of a page looked up together, and written at most writes_per_second.
+    When the Lambda function is about to time out the returned nextToken continues the backfill.
+    """
+    cloudwatch_client = get_client('cloudwatch', account_id, region)
+    started = time.monotonic()
+    counts = {'alarms': 0, 'written': 0}
+    while True:
+        params = {'AlarmTypes': ['MetricAlarm', 'CompositeAlarm'], 'MaxRecords': 100}
+        if next_token:
+            params['NextToken'] = next_token
+        response = cloudwatch_client.describe_alarms(**params)
+        events = [describe_alarm_event(alarm, account_id, region)
+                  for alarm in response.get('MetricAlarms', []) + response.get('CompositeAlarms', [])]
+        counts['alarms'] += len(events)
+
+        stored = get_stored_timestamps(table, [get_alarm_key(event) for event in events])
+        events = [event for event in events
+                  if stored.get(get_alarm_key(event), '') < event['detail']['state']['timestamp']]
+        instance_ids = sorted({get_instance_id(event) for event in events} - {None, ''})
+        if instance_ids:
+            describe_instances(account_id, region, instance_ids)
+
+        def enrich(event):
+            event['AuxiliaryInfo'] = {}
+            event = augment_event(event)
+            event['AuxiliaryInfo']['Suppressed'] = 0
+            return get_alarm_update_params(event, compact)
+
+        with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+            update_params = list(executor.map(enrich, events))
+        counts['written'] += write_alarms(table, update_params)
+
+        # Throughput cap of the table writes
+        time.sleep(max(counts['written'] / writes_per_second - (time.monotonic() - started), 0))
+
+        next_token = response.get('NextToken')
+        if not next_token:
+            print(f'Backfilled {counts["written"]} of {counts["alarms"]} alarms of {account_id} {region}')
+            return counts
+        if context is not None and context.get_remaining_time_in_millis() < 20000:
+            print(f'Backfilled {counts["written"]} of {counts["alarms"]} alarms of {account_id} {region}, '
+                  f'continue with nextToken')
+            return {**counts, 'nextToken': next_token}
+
+
+def get_existing_alarm_names(account_id, region, alarm_names):
+    """Names of the alarms that still exist, checked with describe_alarms calls of 100 names"""
+    cloudwatch_client = get_client('cloudwatch', account_id, region)
+    existing = set()
+    for offset in range(0, len(alarm_names), 100):
+        response = cloudwatch_client.describe_alarms(
+            AlarmNames=alarm_names[offset:offset+100],
+            AlarmTypes=['MetricAlarm', 'CompositeAlarm'],
+            MaxRecords=100
+        )
+        for alarm in response.get('MetricAlarms', []) + response.get('CompositeAlarms', []):
+            existing.add(alarm['AlarmName'])
+    return existing
+
+
+def sweep_page(table, items):
+    """Deletes the alarms of the page that no longer exist and flags the alarms whose EC2 instance no longer exists.
+    Accounts and regions that can't be checked are left as they are.
+    """
+    alarms = {}
+    instances = {}
+    for item in items:
+        if item['alarmKey'].startswith('#'):
+            continue
+        account_id, alarm_name = item['alarmKey'].split('#', 1)
+        alarm_name, region = alarm_name.rsplit('#', 1)
+        alarms.setdefault((account_id, region), {})[alarm_name] = item
+        instance_id = item.get('instanceInfo', {}).get('InstanceId')
+        if instance_id and 'Error' not in item['instanceInfo']:
+            instances.setdefault((account_id, region), {})[instance_id] = item
+
+    lookups = {}
+    for (account_id, region), names in alarms.items():
+        lookups[f'Alarms {account_id} {region}'] = partial(get_existing_alarm_names, account_id, region, sorted(names))
+    for (account_id, region), ids in instances.items():
+        lookups[f'Instances {account_id} {region}'] = partial(describe_instances, account_id, region, sorted(ids))
+    results = run_lookups(lookups, ENRICHMENT_TIMEOUT)
+
+    deleted = set()
+    for (account_id, region), names in alarms.items():
+        if f'Alarms {account_id} {region}' in results:
+            existing = results[f'Alarms {account_id} {region}']
+            deleted.update(item['alarmKey'] for alarm_name, item in names.items() if alarm_name not in existing)
+    with table.batch_writer() as batch:
+        for alarm_key in deleted:
+            batch.delete_item(Key={'alarmKey': alarm_key})
+
+    flagged = []
+    for (account_id, region), ids in instances.items():
+        if f'Instances {account_id} {region}' in results:
+            existing = results[f'Instances {account_id} {region}']
+            flagged += [{
+                'Key': {
+                    'alarmKey': item['alarmKey']
+                },
+                'UpdateExpression': 'SET instanceInfo = :instance_info',
+                # Alarms stored again since they were read have current instance info
+                'ConditionExpression': 'stateTimestamp = :state_timestamp',
+                'ExpressionAttributeValues': {
+                    ':instance_info': {'Error': 'Instance not found', 'InstanceId': instance_id},
+                    ':state_timestamp': item.get('stateTimestamp', '')
+                }
+            } for instance_id, item in ids.items() if instance_id not in existing and item['alarmKey'] not in deleted]
+    return len(deleted), write_alarms(table, flagged)
+
+
+def sweep_segment(table, segment, start_key, context):
+    """Sweeps one scan segment. Returns the counts and the key to continue from when the function is about to time
+    out.
+    """
+    counts = {'scanned': 0, 'deleted': 0, 'flagged': 0}
+    scan_params = {
+        'Segment': segment,
+        'TotalSegments': SWEEP_SEGMENTS,
+        'ProjectionExpression': 'alarmKey, stateTimestamp, instanceInfo'
+    }
+    if start_key:
+        scan_params['ExclusiveStartKey'] = start_key
+    while True:
+        response = table.scan(**scan_params)
+        deleted, flagged = sweep_page(table, response.get('Items', []))
+        counts['scanned'] += len(response.get('Items', []))
+        counts['deleted'] += deleted
+        counts['flagged'] += flagged
+        if 'LastEvaluatedKey' not in response:
+            return counts, None
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        if context is not None and context.get_remaining_time_in_millis() < 20000:
+            return counts, response['LastEvaluatedKey']
+
+
+def sweep(table, context=None):
+    """Removes the alarms that were deleted in the source accounts and flags alarms of deleted EC2 instances. The
+    table is scanned in parallel segments, a sweep that runs out of time is continued by the next scheduled run.
+    """
+    state = table.get_item(Key={'alarmKey': SWEEP_STATE_KEY}).get('Item', {})
+    start_keys = state.get('startKeys', {str(segment): None for segment in range(SWEEP_SEGMENTS)})
+
+    totals = Counter()
+    remaining = {}
+    with ThreadPoolExecutor(max_workers=SWEEP_SEGMENTS) as executor:
+        futures = {executor.submit(sweep_segment, table, int(segment), start_key, context): segment
+                   for segment, start_key in start_keys.items()}
+        for future in as_completed(futures):
+            counts, start_key = future.result()
+            totals.update(counts)
+            if start_key is not None:
+                remaining[futures[future]] = start_key
+
+    if remaining:
+        table.put_item(Item={'alarmKey': SWEEP_STATE_KEY, 'startKeys': remaining})
+    elif state:
+        table.delete_item(Key={'alarmKey': SWEEP_STATE_KEY})
+    print(f'Sweep scanned {totals["scanned"]} items, deleted {totals["deleted"]} alarms and flagged '
+          f'{totals["flagged"]} deleted instances, {len(remaining)} segments continue in the next run')
+    return {**totals, 'complete': not remaining}
+
+
+def get_stored_state(table, event):
+    """Only the small state, tag and account attributes are read so that skipped events cost neither enrichment nor a
+    write
+    """
+    return table.get_item(
+        Key={
+            'alarmKey': get_alarm_key(event)
+        },
+        ProjectionExpression='stateValue, stateTimestamp, lastEventId, alarmTags, alarmTagsExpiresAt, '
+                             'recentTransitions, auxiliaryInfo'
+    ).get('Item')
+
+
+def check_stored_state(item, event):
+    """Reason to skip the event given the stored state of the alarm, or None when the event has to be stored"""
+    if not item or 'stateTimestamp' not in item:
+        return None
+    if item.get('lastEventId') == event.get('id'):
+        return 'Duplicate'
+    if item['stateTimestamp'] > event['detail']['state']['timestamp']:
+        return 'Stale'
+    if item['stateTimestamp'] == event['detail']['state']['timestamp'] or \
+            item.get('stateValue') == event['detail']['state']['value']:
+        return 'Unchanged'
+    return None
+
+
+def store_state_timestamp(table, event):
+    """Moves the state timestamp forward for a newer event with the stored state, so that older events arriving late
+    can't roll the state back. Returns False when the state changed since it was read.
+    """
+    try:
+        table.update_item(
+            Key={
+                'alarmKey': get_alarm_key(event)
+            },
+            UpdateExpression='SET stateTimestamp = :state_timestamp, lastEventId = :event_id',
+            ConditionExpression='stateTimestamp < :state_timestamp AND stateValue = :state_value',
+            ExpressionAttributeValues={
+                ':state_timestamp': event['detail']['state']['timestamp'],
+                ':state_value': event['detail']['state']['value'],
+                ':event_id': event.get('id', '')
+            }
+        )
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
+def get_epoch(state_timestamp):
+    return int(datetime.strptime(state_timestamp, '%Y-%m-%dT%H:%M:%S.%f%z').timestamp())
+
+
+def get_recent_transitions(item, event, coalesced=()):
+    """Epoch seconds of the transitions of the alarm within the flap window, including the event and the events
+    coalesced into it
+    """
+    item = item or {}
+    now = get_epoch(event['detail']['state']['timestamp'])
+    transitions = [int(transition) for transition in item.get('recentTransitions', [])]
+    transitions += [get_epoch(state_timestamp) for state_timestamp in coalesced
+                    if state_timestamp > item.get('stateTimestamp', '')]
+    transitions.append(now)
+    transitions = sorted(transition for transition in transitions if transition > now - flap_settings['window'])
+    # Only whether the threshold is exceeded matters, which keeps the item small for alarms flapping every minute
+    return transitions[-(flap_settings['threshold'] + 1):]
+
+
+def store_flapping_state(table, event, transitions):
+    """Minimal write for a flapping alarm: the state and a counter of the transitions, enrichment is left as stored"""
+    alarm_key = get_alarm_key(event)
+    state = event['detail']['state']
+    try:
+        table.update_item(
+            Key={
+                'alarmKey': alarm_key
+            },
+            UpdateExpression="SET stateValue = :state_value, detail.#state = :state, "
+                             "stateTimestamp = :state_timestamp, lastEventId = :event_id, "
+                             "recentTransitions = :recent_transitions, flapping = :flapping "
+                             "ADD flapCount :one",
+            ConditionExpression='stateTimestamp < :state_timestamp',
+            ExpressionAttributeNames={'#state': 'state'},
+            ExpressionAttributeValues={
+                ':state_value': state['value'],
+                ':state': project(state, ['value', 'timestamp', 'reason']),
+                ':state_timestamp': state['timestamp'],
+                ':event_id': event.get('id', ''),
+                ':recent_transitions': transitions,
+                ':flapping': True,
+                ':one': 1
+            }
+        )
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print(f'Not storing {alarm_key}, a newer state is already stored')
+            return 'Stale'
+        raise
+    print(f'{alarm_key} is flapping, {len(transitions)} transitions within {flap_settings["window"]} seconds')
+    return 'Flapping'
+
+
+def store_history(events):
+    """Records the transitions in the history table, including out of order and coalesced events. It is written before
+    the alarm table so that retried events are recorded again, rewriting a transition is harmless.
+    """
+    if history_settings['table'] is None or not events:
+        return
+    with history_settings['table'].batch_writer(overwrite_by_pkeys=['alarmKey', 'stateTimestamp']) as batch:
+        for event in events:
+            batch.put_item(Item=history_item(get_alarm_key(event), event, history_settings['retention']))
+
+
+def count_transitions(event, count):
+    """Adds the transitions to the daily counter of the alarm in the history table and updates the leaderboard.
+    Counts are approximate, a retried event that failed after counting is counted again.
+    """
+    if history_settings['table'] is None or count == 0:
+        return
+    alarm_key = get_alarm_key(event)
+    day = event['detail']['state']['timestamp'][:10]
+    response = history_settings['table'].update_item(
+        Key={
+            'alarmKey': alarm_key,
+            'stateTimestamp': f'{COUNTER_PREFIX}{day}'
+        },
+        UpdateExpression='SET expiresAt = if_not_exists(expiresAt, :expires_at) ADD transitions :count',
+        ExpressionAttributeValues={
+            ':count': count,
+            ':expires_at': int(time.time()) + history_settings['retention'] * 86400
+        },
+        ReturnValues='UPDATED_NEW'
+    )
+    update_leaderboard(day, alarm_key, int(response['Attributes']['transitions']))
+
+
+def update_leaderboard(day, alarm_key, count):
+    """Keeps the noisiest alarms of the day in one item that alarm_list renders. The item is only written when the
+    alarm enters the leaderboard or changes rank on it, concurrent writers are detected through the version. Counts on
+    the item can lag behind, alarm_list reads the current counts from the daily counters.
+    """
+    table = history_settings['table']
+    size = history_settings['leaderboardSize']
+    for attempt in range(5):
+        leaderboard = leaderboard_cache.get(day)
+        if leaderboard is None:
+            leaderboard = table.get_item(
+                Key={
+                    'alarmKey': LEADERBOARD_KEY,
+                    'stateTimestamp': day
+                }
+            ).get('Item', {'top': {}, 'version': 0})
+            leaderboard_cache[day] = leaderboard
+        top = leaderboard['top']
+        if top.get(alarm_key, 0) >= count:
+            return
+        if alarm_key not in top and len(top) >= size and count <= min(top.values()):
+            return
+
+        ranking = leaderboard_ranking(top)
+        top = dict(top)
+        top[alarm_key] = count
+        if len(top) > size:
+            del top[min(top, key=top.get)]
+        if alarm_key in leaderboard['top'] and leaderboard_ranking(top) == ranking:
+            # Same rank, only the cached copy gets the count so that later rank changes are detected
+            leaderboard_cache[day] = {**leaderboard, 'top': top}
+            return
+        item = {
+            'alarmKey': LEADERBOARD_KEY,
+            'stateTimestamp': day,
+            'top': top,
+            'version': leaderboard['version'] + 1,
+            'expiresAt': int(time.time()) + history_settings['retention'] * 86400
+        }
+        try:
+            table.put_item(
+                Item=item,
+                ConditionExpression='attribute_not_exists(version) OR version = :version',
+                ExpressionAttributeValues={':version': leaderboard['version']}
+            )
+            leaderboard_cache[day] = item
+            return
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            leaderboard_cache.pop(day, None)
+    print(f'ERROR: Could not update the leaderboard of {day} with {alarm_key}, too many concurrent updates')
+
+
+def leaderboard_ranking(top):
+    return sorted(top, key=lambda alarm_key: (-top[alarm_key], alarm_key))
+
+
+def put_skipped_write_metrics(results):
+    """Counts skipped writes by reason through CloudWatch embedded metric format"""
+    for reason, count in Counter(results).items():
+        if reason == 'Stored':
+            continue
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': 'AlarmDashboard',
+                    'Dimensions': [['Reason']],
+                    'Metrics': [{'Name': 'SkippedWrites', 'Unit': 'Count'}]
+                }]
+            },
+            'Reason': reason,
+            'SkippedWrites': count
+        }))
+
+
+def enrichment_timeout(timeout, deadline):
+    """Seconds the enrichment of one alarm may take, the timeout cut short when the invocation deadline is near"""
+    return max(min(timeout, deadline - time.monotonic()), 0)
+
+
+def process_event(event, table, timeout, deadline, compact=True, coalesced=()):
+    """Enriches and stores the event unless it is a duplicate, older than the stored state or doesn't change it.
+    Flapping alarms only get their state updated. Returns Stored or the reason the write was skipped.
+    """
+    if is_tag_change_event(event):
+        return process_tag_change(event, table)
+
+    stored = get_stored_state(table, event)
+    skip_reason = check_stored_state(stored, event)
+    if skip_reason == 'Unchanged' and stored['stateTimestamp'] < event['detail']['state']['timestamp'] and \
+            not store_state_timestamp(table, event):
+        # The state changed since it was read, the conditional write below decides whether the event is newer
+        skip_reason = None
+    if skip_reason is not None:
+        print(f'Skipping {skip_reason.lower()} event {event.get("id")} for {get_alarm_key(event)}')
+        # Unchanged and stale events aren't transitions, the events coalesced into them were
+        if skip_reason != 'Duplicate':
+            count_transitions(event, len(coalesced))
+        return skip_reason
+    count_transitions(event, 1 + len(coalesced))
+
+    if flap_settings['threshold'] > 0:
+        transitions = get_recent_transitions(stored, event, coalesced)
+        if stored and 'stateTimestamp' in stored and len(transitions) > flap_settings['threshold']:
+            return store_flapping_state(table, event, transitions)
+        event['RecentTransitions'] = transitions
+
+    event['AuxiliaryInfo'] = {}
+
+    event = augment_event(event, enrichment_timeout(timeout, deadline), stored)
+
+    event['AuxiliaryInfo']['Suppressed'] = 0
+
+    return store_alarm_event(table, event, compact)
+
+
+def process_batch(records, table, timeout, deadline, compact=True):
+    """Alarm events delivered by SQS. Events are coalesced per alarm so that only the latest state of every alarm is
+    enriched and stored. Every alarm gets its own enrichment timeout, the deadline only caps the alarms processed last.
+    Messages of alarms that couldn't be stored are reported as batch item failures.
+    """
+    latest_events = {}
+    # State timestamps of the events coalesced into the latest event, they count as transitions for flap detection
+    coalesced = {}
+    message_ids = {}
+    failures = []
+    results = []
+    alarm_events = []
+    for record in records:
+        try:
+            event = json.loads(record['body'])
+            if is_tag_change_event(event):
+                results.append(process_tag_change(event, table))
+                continue
+            alarm_key = get_alarm_key(event)
+        except Exception as e:
+            print(f"ERROR: Could not process message {record['messageId']}: {e}")
+            failures.append(record['messageId'])
+            continue
+        message_ids.setdefault(alarm_key, []).append(record['messageId'])
+        alarm_events.append(event)
+        if alarm_key not in latest_events:
+            latest_events[alarm_key] = event
+            continue
+        results.append('Coalesced')
+        if event['detail']['state']['timestamp'] >= latest_events[alarm_key]['detail']['state']['timestamp']:
+            event, latest_events[alarm_key] = latest_events[alarm_key], event
+        coalesced.setdefault(alarm_key, []).append(event['detail']['state']['timestamp'])
+    print(f'Coalesced {len(records)} events into {len(latest_events)} alarms')
+
+    try:
+        store_history(alarm_events)
+    except Exception as e:
+        print(f'ERROR: Recording the history failed: {e}')
+        failures.extend(message_id for alarm_message_ids in message_ids.values() for message_id in alarm_message_ids)
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
+
+    # Look up every account and the EC2 instances of every account and region of the batch once,
+    # the alarms then find them in the account and instance caches
+    account_regions = {}
+    instance_ids = {}
+    for event in latest_events.values():
+        account_regions.setdefault(event['account'], event['region'])
+        instance_id = get_instance_id(event)
+        if instance_id:
+            instance_ids.setdefault((event['account'], event['region']), set()).add(instance_id)
+    lookups = {}
+    for account_id, region in account_regions.items():
+        lookups[f'Account {account_id}'] = partial(get_account_info, account_id, region)
+        lookups[f'AlternateContact {account_id}'] = partial(get_alternate_contact, account_id, region)
+    for (account_id, region), ids in instance_ids.items():
+        lookups[f'Instances {account_id} {region}'] = partial(describe_instances, account_id, region, sorted(ids))
+    run_lookups(lookups, enrichment_timeout(timeout, deadline))
+
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        futures = {executor.submit(process_event, event, table, timeout, deadline, compact,
+                                   coalesced.get(alarm_key, ())):
+                   alarm_key
+                   for alarm_key, event in latest_events.items()}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f'ERROR: Storing {futures[future]} failed: {e}')
+                failures.extend(message_ids[futures[future]])
+
+    put_skipped_write_metrics(results)
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
+
+
+def lambda_handler(event, context):
+    config = get_config()
+    table = ThreadLocalTable(config['dynamoTableName'])
+    account_cache_settings['ttl'] = config.get('accountCacheTTL', 86400)
+    account_cache_settings['table'] = table if config.get('sharedAccountCache') else None
+    alarm_tag_cache_settings['ttl'] = config.get('alarmTagCacheTTL', 3600)
+    client_settings['timeout'] = config.get('enrichmentTimeout', ENRICHMENT_TIMEOUT)
+    flap_settings['window'] = config.get('flapWindowSeconds', 3600)
+    flap_settings['threshold'] = config.get('flapThreshold', 0)
+    history_settings['table'] = ThreadLocalTable(config['historyTableName']) if config.get('historyTableName') else None
+    history_settings['retention'] = config.get('historyRetentionDays', 90)
+    history_settings['leaderboardSize'] = config.get('leaderboardSize', 20)
+
+    if event.get('warmAccountCache'):
+        return {'accounts': warm_account_cache(event.get('region', boto3.session.Session().region_name))}
+
+    if event.get('migrateCompactSchema'):
+        return migrate_compact_schema(table, event.get('startKey'), context)
+
+    if event.get('sweep'):
+        return sweep(table, context)
+
+    if event.get('backfill'):
+        return backfill_alarms(table, event['account'], event['region'], config.get('compactSchema', True), context,
+                               event.get('nextToken'), event.get('writesPerSecond', 100))
+
+    timeout = config.get('enrichmentTimeout', ENRICHMENT_TIMEOUT)
+    # Leave time to store the events when enrichment is slow
+    deadline = math.inf
+    if context is not None:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - 5
+
+    compact = config.get('compactSchema', True)
+    if 'Records' in event:
+        result = process_batch(event['Records'], table, timeout, deadline, compact)
+    else:
+        if not is_tag_change_event(event):
+            store_history([event])
+        result = process_event(event, table, timeout, deadline, compact)
+        put_skipped_write_metrics([result])
+    print(f"Cache stats: {cache_stats}")
+    return result
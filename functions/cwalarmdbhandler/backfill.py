@@ -0,0 +1,75 @@
+"""Backfills the alarm table with the current state of every alarm in the organization.
+
+The alarm handler reads the alarms of one account and region with the same cross account role it uses for alarm
+events, so this script invokes it for every account and region concurrently and continues invocations that ran out
+of time. Alarms stored with a newer state are left as they are.
+
+    python3 backfill.py --regions eu-west-1 us-east-1 --concurrency 20 --max-writes-per-second 500
+"""
+import argparse
+import json
+import boto3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
+
+FUNCTION_NAME = 'CloudWatchAlarmDynamoDBHandlerCDK'
+
+
+def list_account_ids():
+    organizations_client = boto3.client('organizations')
+    return [account['Id']
+            for page in organizations_client.get_paginator('list_accounts').paginate()
+            for account in page['Accounts'] if account['Status'] == 'ACTIVE']
+
+
+def backfill(lambda_client, function_name, account_id, region, writes_per_second):
+    """Invokes the handler until every alarm of the account and region was read"""
+    totals = {'alarms': 0, 'written': 0}
+    payload = {'backfill': True, 'account': account_id, 'region': region, 'writesPerSecond': writes_per_second}
+    while True:
+        response = lambda_client.invoke(FunctionName=function_name, Payload=json.dumps(payload))
+        result = json.loads(response['Payload'].read())
+        if 'FunctionError' in response:
+            raise Exception(result.get('errorMessage', result))
+        totals['alarms'] += result['alarms']
+        totals['written'] += result['written']
+        if 'nextToken' not in result:
+            return totals
+        payload['nextToken'] = result['nextToken']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backfill the alarm table with the current state of all alarms')
+    parser.add_argument('--regions', nargs='+', required=True, help='regions of the alarms')
+    parser.add_argument('--accounts', nargs='+', help='account ids, defaults to the active accounts of the organization')
+    parser.add_argument('--function-name', default=FUNCTION_NAME, help='name of the alarm handler function')
+    parser.add_argument('--concurrency', type=int, default=10, help='concurrent handler invocations')
+    parser.add_argument('--max-writes-per-second', type=int, default=500,
+                        help='cap of the alarm writes per second over all invocations')
+    args = parser.parse_args()
+
+    accounts = args.accounts or list_account_ids()
+    # Invocations run until the function times out, the default read timeout is shorter
+    client = boto3.client('lambda', config=Config(read_timeout=900, retries={'max_attempts': 0},
+                                                  max_pool_connections=args.concurrency))
+    per_invocation = max(args.max_writes_per_second // args.concurrency, 1)
+    totals = {'alarms': 0, 'written': 0}
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(backfill, client, args.function_name, account_id, region, per_invocation):
+                   (account_id, region)
+                   for account_id in accounts for region in args.regions}
+        for future in as_completed(futures):
+            account_id, region = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f'ERROR: Backfilling {account_id} {region} failed: {e}')
+                failed.append(futures[future])
+                continue
+            totals['alarms'] += result['alarms']
+            totals['written'] += result['written']
+            print(f'{account_id} {region}: {result["written"]} of {result["alarms"]} alarms written')
+
+    print(f'Backfilled {totals["written"]} of {totals["alarms"]} alarms in {len(futures)} accounts and regions, '
+          f'{len(failed)} failed')
@@ -0,0 +1,144 @@
+"""Alarm state transition history.
+
+Every state change is an item of the history table keyed by alarmKey and stateTimestamp, so the history of one alarm
+is a range query on the table. The DayIndex GSI is keyed by the day of the transition and stateTimestamp, so all
+transitions within a time window are one range query per day. The table also holds daily transition counters per
+alarm and a daily leaderboard of the noisiest alarms, which have no day attribute and stay out of the DayIndex.
+
+    python3 history.py --alarm-key '111111111111#HighCPU#eu-west-1' --days 7
+    python3 history.py --start 2024-01-01T00:00:00 --end 2024-01-08T00:00:00
+"""
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+from boto3.dynamodb.conditions import Key
+
+DAY_INDEX = 'DayIndex'
+# Sort key prefix of the daily transition counter items of an alarm, they sort before the transitions
+COUNTER_PREFIX = '#count#'
+# Partition key of the daily leaderboard items of the noisiest alarms, the sort key is the day
+LEADERBOARD_KEY = '#leaderboard'
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f%z'
+
+
+def parse_timestamp(state_timestamp):
+    return datetime.strptime(state_timestamp, TIMESTAMP_FORMAT)
+
+
+def format_timestamp(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.000+0000')
+
+
+def history_item(alarm_key, event, retention_days):
+    """History item of an alarm state change event, expired by the DynamoDB TTL after retention_days"""
+    state_timestamp = event['detail']['state']['timestamp']
+    return {
+        'alarmKey': alarm_key,
+        'stateTimestamp': state_timestamp,
+        'stateValue': event['detail']['state']['value'],
+        'previousStateValue': event['detail'].get('previousState', {}).get('value', ''),
+        'day': state_timestamp[:10],
+        'expiresAt': int(time.time()) + retention_days * 86400
+    }
+
+
+def query_pages(table, **kwargs):
+    while True:
+        response = table.query(**kwargs)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query_alarm_history(table, alarm_key, start, end):
+    """Transitions of one alarm between start and end in time order"""
+    return query_pages(
+        table,
+        KeyConditionExpression=Key('alarmKey').eq(alarm_key) &
+        Key('stateTimestamp').between(format_timestamp(start), format_timestamp(end))
+    )
+
+
+def query_window(table, start, end):
+    """Transitions of all alarms between start and end in time order, one query per day"""
+    day = start.date()
+    while day <= end.date():
+        yield from query_pages(
+            table,
+            IndexName=DAY_INDEX,
+            KeyConditionExpression=Key('day').eq(day.isoformat()) &
+            Key('stateTimestamp').between(format_timestamp(start), format_timestamp(end))
+        )
+        day += timedelta(days=1)
+
+
+def summarize(transitions, start, end):
+    """Time in state and MTTR per alarm in one pass over transitions in time order.
+
+    The state before the first transition of an alarm is the previous state of that transition. Time in state is in
+    seconds and clipped to the window, MTTR is the mean duration of the ALARM periods that started and recovered within
+    the window, or None when there were none.
+    """
+    alarms = {}
+    for transition in transitions:
+        moment = parse_timestamp(transition['stateTimestamp'])
+        alarm = alarms.get(transition['alarmKey'])
+        if alarm is None:
+            alarm = alarms[transition['alarmKey']] = {
+                'state': transition.get('previousStateValue') or None,
+                'since': start,
+                'alarmStart': None,
+                'timeInState': {},
+                'recoveries': [],
+                'transitions': 0
+            }
+        if alarm['state'] is not None:
+            alarm['timeInState'][alarm['state']] = \
+                alarm['timeInState'].get(alarm['state'], 0) + (moment - alarm['since']).total_seconds()
+        if transition['stateValue'] == 'ALARM' and alarm['state'] != 'ALARM':
+            alarm['alarmStart'] = moment
+        elif transition['stateValue'] != 'ALARM' and alarm['alarmStart'] is not None:
+            alarm['recoveries'].append((moment - alarm['alarmStart']).total_seconds())
+            alarm['alarmStart'] = None
+        alarm['state'] = transition['stateValue']
+        alarm['since'] = moment
+        alarm['transitions'] += 1
+
+    summary = {}
+    for alarm_key, alarm in alarms.items():
+        alarm['timeInState'][alarm['state']] = \
+            alarm['timeInState'].get(alarm['state'], 0) + (end - alarm['since']).total_seconds()
+        summary[alarm_key] = {
+            'timeInState': alarm['timeInState'],
+            'transitions': alarm['transitions'],
+            'recoveries': len(alarm['recoveries']),
+            'mttr': sum(alarm['recoveries']) / len(alarm['recoveries']) if alarm['recoveries'] else None
+        }
+    return summary
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+if __name__ == '__main__':
+    import boto3
+    import json
+
+    parser = argparse.ArgumentParser(description='Time in state and MTTR of alarms from the alarm history table')
+    parser.add_argument('--table', default='AlarmHistoryTableCDK', help='name of the history table')
+    parser.add_argument('--alarm-key', help='account#alarmName#region of one alarm, all alarms when omitted')
+    parser.add_argument('--start', type=parse_time, help='start of the window, UTC ISO format')
+    parser.add_argument('--end', type=parse_time, help='end of the window, UTC ISO format, defaults to now')
+    parser.add_argument('--days', type=int, default=7, help='length of the window when --start is omitted')
+    args = parser.parse_args()
+
+    window_end = args.end or datetime.now(timezone.utc)
+    window_start = args.start or window_end - timedelta(days=args.days)
+    history_table = boto3.resource('dynamodb').Table(args.table)
+    if args.alarm_key:
+        items = query_alarm_history(history_table, args.alarm_key, window_start, window_end)
+    else:
+        items = query_window(history_table, window_start, window_end)
+    print(json.dumps(summarize(items, window_start, window_end), indent=2))
@@ -0,0 +1,449 @@
+"""Local load test of the alarm ingestion path.
+
+Generates synthetic CloudWatch Alarm State Change events and runs app.lambda_handler against an in-memory DynamoDB
+table and stubbed AWS endpoints with configurable latency. Nothing is sent to AWS.
+
+    python3 loadtest.py --events 2000 --accounts 50 --regions eu-west-1 us-east-1 --latency 30 --concurrency 8
+"""
+import argparse
+import copy
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import nullcontext, redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+# The handler creates its clients on import, the stubs have to be in place before
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+os.environ['AWS_ACCESS_KEY_ID'] = 'loadtest'
+os.environ['AWS_SECRET_ACCESS_KEY'] = 'loadtest'
+os.environ.pop('AWS_PROFILE', None)
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+
+MONITORING_ACCOUNT = '000000000000'
+TABLE_NAME = 'AlarmStateChangeTableCDK'
+HISTORY_TABLE_NAME = 'AlarmHistoryTableCDK'
+
+
+class StubbedAWS:
+    """Answers every AWS call of the handler locally after sleeping the configured latency and counts the calls"""
+
+    def __init__(self, latency_ms, config):
+        self.latency = latency_ms / 1000
+        self.config = config
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, model, params, context, **kwargs):
+        operation = model.name
+        with self.lock:
+            self.calls[operation] += 1
+        time.sleep(self.latency)
+        match operation:
+            case 'GetCallerIdentity':
+                return self.ok({'Account': MONITORING_ACCOUNT, 'Arn': 'arn', 'UserId': 'loadtest'})
+            case 'AssumeRole':
+                return self.ok({'Credentials': {
+                    'AccessKeyId': 'loadtest',
+                    'SecretAccessKey': 'loadtest',
+                    'SessionToken': 'loadtest',
+                    'Expiration': datetime.now(timezone.utc) + timedelta(hours=1)
+                }})
+            case 'GetParameter':
+                return self.ok({'Parameter': {'Value': json.dumps(self.config)}})
+            case 'ListTagsForResource':
+                return self.ok({'Tags': [{'Key': 'priority', 'Value': random.choice(['critical', 'medium', 'low'])}]})
+            case 'GetAlternateContact':
+                return self.ok({'AlternateContact': {
+                    'AlternateContactType': 'OPERATIONS',
+                    'Name': 'Operations',
+                    'Title': 'On call',
+                    'EmailAddress': 'ops@example.com',
+                    'PhoneNumber': '+10000000000'
+                }})
+            case 'DescribeAccount':
+                return self.ok({'Account': self.account()})
+            case 'ListAccounts':
+                return self.ok({'Accounts': []})
+            case 'DescribeInstances':
+                instance_ids = [value for key, value in params['body'].items()
+                                if key.startswith('InstanceId') or key.startswith('Filter.1.Value')]
+                return self.ok({'Reservations': [{'Instances': [self.instance(instance_id)
+                                                                for instance_id in instance_ids]}]})
+        raise Exception(f'Operation {operation} is not stubbed')
+
+    @staticmethod
+    def ok(response):
+        return AWSResponse(None, 200, {}, None), response
+
+    @staticmethod
+    def account():
+        return {'Id': '111111111111', 'Arn': 'arn', 'Email': 'account@example.com', 'Name': 'loadtest',
+                'Status': 'ACTIVE', 'JoinedMethod': 'CREATED', 'JoinedTimestamp': datetime(2020, 1, 1)}
+
+    @staticmethod
+    def instance(instance_id):
+        return {'InstanceId': instance_id, 'InstanceType': 't3.micro', 'ImageId': 'ami-00000000',
+                'LaunchTime': datetime(2024, 1, 1), 'State': {'Code': 16, 'Name': 'running'},
+                'Tags': [{'Key': 'Name', 'Value': instance_id}]}
+
+
+class InMemoryTable:
+    """Stand-in for the boto3 DynamoDB Table supporting the expressions the alarm functions use"""
+
+    def __init__(self, latency_ms, key_names=('alarmKey',)):
+        self.latency = latency_ms / 1000
+        self.key_names = key_names
+        self.items = {}
+        self.lock = threading.Lock()
+        self.requests = Counter()
+
+    def request(self, operation):
+        with self.lock:
+            self.requests[operation] += 1
+        time.sleep(self.latency)
+
+    def get_item(self, Key, ProjectionExpression=None, **kwargs):
+        self.request('GetItem')
+        with self.lock:
+            item = copy.deepcopy(self.items.get(self.key(Key)))
+        if item is None:
+            return {}
+        if ProjectionExpression:
+            names = kwargs.get('ExpressionAttributeNames', {})
+            fields = [names.get(field.strip(), field.strip()) for field in ProjectionExpression.split(',')]
+            item = {field: item[field] for field in fields if field in item}
+        return {'Item': item}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        self.request('PutItem')
+        with self.lock:
+            if ConditionExpression and not self.condition(ConditionExpression, self.items.get(self.key(Item), {}),
+                                                          ExpressionAttributeValues or {}, {}):
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                             'Message': 'The conditional request failed'}}, 'PutItem')
+            self.items[self.key(Item)] = copy.deepcopy(Item)
+        return {}
+
+    def key(self, item):
+        return tuple(item[name] for name in self.key_names)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None,
+                    ConditionExpression=None, **kwargs):
+        self.request('UpdateItem')
+        values = ExpressionAttributeValues or {}
+        names = ExpressionAttributeNames or {}
+        with self.lock:
+            item = copy.deepcopy(self.items.get(self.key(Key), dict(Key)))
+            exists = self.key(Key) in self.items
+            if ConditionExpression and not self.condition(ConditionExpression, item if exists else {}, values, names):
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                             'Message': 'The conditional request failed'}}, 'UpdateItem')
+            for action, clauses in re.findall(r'(SET|ADD|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|REMOVE)\s|$)',
+                                              UpdateExpression):
+                for clause in split_top_level(clauses):
+                    self.apply(action, clause.strip(), item, values, names)
+            self.items[self.key(Key)] = item
+        return {'Attributes': copy.deepcopy(item)}
+
+    def scan(self, ExclusiveStartKey=None, **kwargs):
+        self.request('Scan')
+        with self.lock:
+            return {'Items': copy.deepcopy(list(self.items.values()))}
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return InMemoryBatchWriter(self)
+
+    def delete_item(self, Key, **kwargs):
+        self.request('DeleteItem')
+        with self.lock:
+            self.items.pop(self.key(Key), None)
+        return {}
+
+    def apply(self, action, clause, item, values, names):
+        if action == 'REMOVE':
+            item.pop(names.get(clause, clause), None)
+            return
+        if action == 'ADD':
+            name, value = clause.split()
+            name = names.get(name, name)
+            item[name] = item.get(name, 0) + values[value]
+            return
+        name, expression = [part.strip() for part in clause.split('=', 1)]
+        value = self.operand(expression, item, values, names)
+        *parents, name = [names.get(part, part) for part in name.split('.')]
+        for parent in parents:
+            item = item[parent]
+        item[name] = value
+
+    def operand(self, expression, item, values, names):
+        function = re.match(r'(if_not_exists|list_append)\((.*)\)$', expression)
+        if function:
+            first, second = split_top_level(function.group(2))
+            if function.group(1) == 'if_not_exists':
+                attribute = names.get(first.strip(), first.strip())
+                return item[attribute] if attribute in item else self.operand(second.strip(), item, values, names)
+            return self.operand(first.strip(), item, values, names) + self.operand(second.strip(), item, values, names)
+        if ' + ' in expression or ' - ' in expression:
+            left, operator, right = re.split(r'\s([+-])\s', expression, maxsplit=1)
+            left = self.operand(left.strip(), item, values, names)
+            right = self.operand(right.strip(), item, values, names)
+            return left + right if operator == '+' else left - right
+        if expression.startswith(':'):
+            return copy.deepcopy(values[expression])
+        return copy.deepcopy(item.get(names.get(expression, expression)))
+
+    def condition(self, expression, item, values, names):
+        for alternative in re.split(r'\s+OR\s+', expression.strip('() ')):
+            if all(self.comparison(part.strip('() '), item, values, names)
+                   for part in re.split(r'\s+AND\s+', alternative)):
+                return True
+        return False
+
+    def comparison(self, expression, item, values, names):
+        function = re.match(r'(attribute_exists|attribute_not_exists)\((.*)$', expression)
+        if function:
+            attribute = names.get(function.group(2).strip(' )'), function.group(2).strip(' )'))
+            return (attribute in item) == (function.group(1) == 'attribute_exists')
+        left, operator, right = re.split(r'\s*(<=|>=|<>|<|>|=)\s*', expression, maxsplit=1)
+        left = self.operand(left, item, values, names)
+        right = self.operand(right, item, values, names)
+        if left is None or right is None:
+            return False
+        return {'<': left < right, '<=': left <= right, '>': left > right, '>=': left >= right,
+                '=': left == right, '<>': left != right}[operator]
+
+
+class InMemoryBatchWriter:
+    """Writes the items in BatchWriteItem requests of 25 like the boto3 batch writer"""
+
+    def __init__(self, table):
+        self.table = table
+        self.items = []
+
+    def put_item(self, Item):
+        self.items.append(copy.deepcopy(Item))
+        if len(self.items) == 25:
+            self.flush()
+
+    def flush(self):
+        if not self.items:
+            return
+        self.table.request('BatchWriteItem')
+        with self.table.lock:
+            for item in self.items:
+                self.table.items[self.table.key(item)] = item
+        self.items = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+        return False
+
+
+class InMemoryDynamoDB:
+    def __init__(self, tables):
+        self.tables = tables
+
+    def Table(self, name):
+        return self.tables[name]
+
+
+class LambdaContext:
+    invoked_function_arn = 'arn:aws:lambda:eu-west-1:000000000000:function:loadtest'
+
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+def split_top_level(expression):
+    """Splits on commas that aren't inside parentheses"""
+    parts = []
+    depth = 0
+    current = ''
+    for char in expression:
+        if char == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+            continue
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        current += char
+    parts.append(current)
+    return parts
+
+
+def standard_alarm(instance_id):
+    return {'metrics': [{
+        'id': 'm1',
+        'metricStat': {
+            'metric': {'namespace': 'AWS/EC2', 'name': 'CPUUtilization', 'dimensions': {'InstanceId': instance_id}},
+            'period': 300,
+            'stat': 'Average'
+        },
+        'returnData': True
+    }]}
+
+
+def expression_alarm(alarm_name):
+    return {'metrics': [
+        {'id': 'e1', 'expression': 'm1/m2*100', 'label': f'{alarm_name} error rate', 'returnData': True},
+        {'id': 'm1', 'metricStat': {'metric': {'namespace': 'AWS/Lambda', 'name': 'Errors',
+                                               'dimensions': {'FunctionName': alarm_name}},
+                                    'period': 60, 'stat': 'Sum'}, 'returnData': False},
+        {'id': 'm2', 'metricStat': {'metric': {'namespace': 'AWS/Lambda', 'name': 'Invocations',
+                                               'dimensions': {'FunctionName': alarm_name}},
+                                    'period': 60, 'stat': 'Sum'}, 'returnData': False}
+    ]}
+
+
+def composite_alarm(alarm_name):
+    return {'alarmRule': f'ALARM("{alarm_name}-cpu") OR ALARM("{alarm_name}-errors")'}
+
+
+def generate_events(count, accounts, regions, alarms_per_account, instances_per_account, seed=None):
+    """Synthetic alarm state change events. Alarms are spread over accounts and regions, half of them are standard
+    EC2 alarms, the rest expression and composite alarms. Every alarm transitions between ALARM and OK.
+    """
+    rng = random.Random(seed)
+    alarm_states = {}
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for n in range(count):
+        account_id = f'{100000000000 + rng.randrange(accounts)}'
+        region = rng.choice(regions)
+        alarm_number = rng.randrange(alarms_per_account)
+        alarm_type = ['standard', 'standard', 'expression', 'composite'][alarm_number % 4]
+        alarm_name = f'loadtest-{alarm_type}-{alarm_number}'
+        alarm_arn = f'arn:aws:cloudwatch:{region}:{account_id}:alarm:{alarm_name}'
+        previous_state = alarm_states.get(alarm_arn, 'OK')
+        state = 'OK' if previous_state == 'ALARM' else 'ALARM'
+        alarm_states[alarm_arn] = state
+        timestamp = (start + timedelta(seconds=n)).strftime('%Y-%m-%dT%H:%M:%S.000+0000')
+
+        if alarm_type == 'standard':
+            configuration = standard_alarm(f'i-{alarm_number % instances_per_account:017x}')
+        elif alarm_type == 'expression':
+            configuration = expression_alarm(alarm_name)
+        else:
+            configuration = composite_alarm(alarm_name)
+        configuration['description'] = f'Synthetic {alarm_type} alarm'
+
+        yield {
+            'version': '0',
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'detail-type': 'CloudWatch Alarm State Change',
+            'source': 'aws.cloudwatch',
+            'account': account_id,
+            'time': timestamp,
+            'region': region,
+            'resources': [alarm_arn],
+            'detail': {
+                'alarmName': alarm_name,
+                'state': {'value': state, 'reason': f'Synthetic transition to {state}', 'timestamp': timestamp},
+                'previousState': {'value': previous_state, 'reason': 'Synthetic', 'timestamp': timestamp},
+                'configuration': configuration
+            }
+        }
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def run(args):
+    config = {
+        'dynamoTableName': TABLE_NAME,
+        'historyTableName': HISTORY_TABLE_NAME if not args.no_history else None,
+        'compactSchema': not args.full_schema,
+        'flapThreshold': args.flap_threshold,
+        'flapWindowSeconds': args.flap_window
+    }
+    stub = StubbedAWS(args.latency, config)
+    boto3.setup_default_session(region_name=os.environ['AWS_DEFAULT_REGION'])
+    boto3.DEFAULT_SESSION.events.register('before-call', stub)
+
+    # The configuration module is deployed as a Lambda layer
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common', 'python'))
+    import app
+    table = InMemoryTable(args.ddb_latency)
+    history_table = InMemoryTable(args.ddb_latency, ('alarmKey', 'stateTimestamp'))
+    dynamodb = InMemoryDynamoDB({TABLE_NAME: table, HISTORY_TABLE_NAME: history_table})
+    app.get_dynamodb = lambda: dynamodb
+
+    events = list(generate_events(args.events, args.accounts, args.regions, args.alarms, args.instances, args.seed))
+    if args.batch_size > 1:
+        invocations = [{'Records': [{'messageId': event['id'], 'body': json.dumps(event)}
+                                    for event in events[offset:offset + args.batch_size]]}
+                       for offset in range(0, len(events), args.batch_size)]
+    else:
+        invocations = events
+
+    latencies = []
+    results = Counter()
+    latencies_lock = threading.Lock()
+
+    def invoke(event):
+        started = time.perf_counter()
+        result = app.lambda_handler(event, LambdaContext())
+        with latencies_lock:
+            latencies.append(time.perf_counter() - started)
+            # Single events return why the write was skipped, batches return the failed messages
+            results[result if isinstance(result, str) else 'Batch'] += 1
+
+    handler_output = io.StringIO()
+    started = time.perf_counter()
+    with nullcontext() if args.verbose else redirect_stdout(handler_output), \
+            ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(invoke, invocations))
+    elapsed = time.perf_counter() - started
+
+    api_calls = sum(count for operation, count in stub.calls.items() if operation != 'GetParameter')
+    print(f'Events:               {len(events)} in {len(invocations)} invocations')
+    print(f'Elapsed:              {elapsed:.2f} s')
+    print(f'Throughput:           {len(events) / elapsed:.1f} events/s')
+    print(f'Invocation latency:   p50 {percentile(latencies, 50) * 1000:.1f} ms, '
+          f'p90 {percentile(latencies, 90) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms, '
+          f'max {max(latencies) * 1000:.1f} ms')
+    print(f'API calls per event:  {api_calls / len(events):.2f} (without config reads)')
+    for operation, count in sorted(stub.calls.items()):
+        print(f'    {operation:<24}{count:>8}  {count / len(events):.3f}/event')
+    ddb_requests = table.requests + history_table.requests
+    print(f'DynamoDB requests per event: {sum(ddb_requests.values()) / len(events):.2f}')
+    for operation, count in sorted(ddb_requests.items()):
+        print(f'    {operation:<24}{count:>8}  {count / len(events):.3f}/event')
+    print(f'Stored alarms:        {len(table.items)}')
+    print(f'Stored transitions:   {sum(1 for item in history_table.items.values() if "day" in item)}')
+    print(f'Results:              {dict(results)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local load test of the alarm ingestion path')
+    parser.add_argument('--events', type=int, default=1000, help='number of alarm state change events')
+    parser.add_argument('--accounts', type=int, default=20, help='number of source accounts')
+    parser.add_argument('--regions', nargs='+', default=['eu-west-1', 'us-east-1'], help='source regions')
+    parser.add_argument('--alarms', type=int, default=100, help='alarms per account and region')
+    parser.add_argument('--instances', type=int, default=50, help='EC2 instances per account the alarms point at')
+    parser.add_argument('--latency', type=float, default=20, help='latency of the stubbed AWS endpoints in ms')
+    parser.add_argument('--ddb-latency', type=float, default=5, help='latency of the DynamoDB stand-in in ms')
+    parser.add_argument('--concurrency', type=int, default=1, help='concurrent Lambda invocations')
+    parser.add_argument('--batch-size', type=int, default=1, help='events per invocation, >1 delivers SQS batches')
+    parser.add_argument('--full-schema', action='store_true', help='store full events instead of the compact schema')
+    parser.add_argument('--flap-threshold', type=int, default=0, help='flap detection threshold, 0 disables it')
+    parser.add_argument('--flap-window', type=int, default=3600, help='flap detection window in seconds')
+    parser.add_argument('--no-history', action='store_true', help='do not record transitions in the history table')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the handler')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the generated events')
+    run(parser.parse_args())
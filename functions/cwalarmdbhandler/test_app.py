@@ -0,0 +1,171 @@
+"""Tests of the alarm handler against the in-memory table and stubbed AWS endpoints of the load test.
+
+    cd functions/cwalarmdbhandler && python3 -m pytest test_app.py
+"""
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common', 'python'))
+
+# loadtest sets up local credentials before boto3 creates any client
+from loadtest import TABLE_NAME, InMemoryTable, StubbedAWS, standard_alarm
+import boto3
+import pytest
+from boto3.dynamodb.types import TypeSerializer
+
+boto3.setup_default_session(region_name=os.environ['AWS_DEFAULT_REGION'])
+boto3.DEFAULT_SESSION.events.register('before-call', StubbedAWS(0, {'dynamoTableName': TABLE_NAME}))
+
+import app
+
+ACCOUNT_ID = '111111111111'
+REGION = 'eu-west-1'
+ALARM_NAME = 'test-cpu'
+
+
+def alarm_event(state, timestamp, event_id):
+    return {
+        'version': '0',
+        'id': event_id,
+        'detail-type': 'CloudWatch Alarm State Change',
+        'source': 'aws.cloudwatch',
+        'account': ACCOUNT_ID,
+        'time': timestamp,
+        'region': REGION,
+        'resources': [f'arn:aws:cloudwatch:{REGION}:{ACCOUNT_ID}:alarm:{ALARM_NAME}'],
+        'detail': {
+            'alarmName': ALARM_NAME,
+            'state': {'value': state, 'reason': f'Test transition to {state}', 'timestamp': timestamp},
+            'configuration': standard_alarm('i-0123456789abcdef0')
+        }
+    }
+
+
+def stored_alarm(table):
+    return table.items[(f'{ACCOUNT_ID}#{ALARM_NAME}#{REGION}',)]
+
+
+def test_late_event_does_not_roll_back_unchanged_state():
+    table = InMemoryTable(0)
+    events = [
+        alarm_event('OK', '2024-01-01T00:00:00.000+0000', 'e1'),
+        alarm_event('OK', '2024-01-01T00:02:00.000+0000', 'e2'),
+        # Arrives last although it happened before the second OK
+        alarm_event('ALARM', '2024-01-01T00:01:00.000+0000', 'e3')
+    ]
+
+    results = [app.process_event(event, table, 1, math.inf) for event in events]
+
+    assert results == ['Stored', 'Unchanged', 'Stale']
+    item = stored_alarm(table)
+    assert item['stateValue'] == 'OK'
+    assert item['stateTimestamp'] == '2024-01-01T00:02:00.000+0000'
+    assert item['lastEventId'] == 'e2'
+    # The skipped event doesn't replace the enriched detail of the first event
+    assert item['detail']['state']['timestamp'] == '2024-01-01T00:00:00.000+0000'
+
+
+def test_unchanged_event_stored_when_state_changed_since_read(monkeypatch):
+    table = InMemoryTable(0)
+    app.process_event(alarm_event('OK', '2024-01-01T00:00:00.000+0000', 'e1'), table, 1, math.inf)
+    stored = app.get_stored_state(table, alarm_event('OK', '2024-01-01T00:02:00.000+0000', 'e2'))
+    app.process_event(alarm_event('ALARM', '2024-01-01T00:01:00.000+0000', 'e3'), table, 1, math.inf)
+
+    # The OK event read the state before the ALARM event was stored
+    monkeypatch.setattr(app, 'get_stored_state', lambda table, event: stored)
+    result = app.process_event(alarm_event('OK', '2024-01-01T00:02:00.000+0000', 'e2'), table, 1, math.inf)
+
+    assert result == 'Stored'
+    assert stored_alarm(table)['stateValue'] == 'OK'
+
+
+def test_full_schema_stores_serializable_instance_info():
+    table = InMemoryTable(0)
+
+    result = app.process_event(alarm_event('ALARM', '2024-01-01T00:00:00.000+0000', 'e1'), table, 1, math.inf,
+                               compact=False)
+
+    assert result == 'Stored'
+    item = stored_alarm(table)
+    # describe_instances returns LaunchTime as a datetime, which DynamoDB can't store
+    assert item['instanceInfo']['LaunchTime'] == '2024-01-01 00:00:00'
+    assert item['instanceInfo']['InstanceType'] == 't3.micro'
+    for value in item.values():
+        TypeSerializer().serialize(value)
+
+
+def test_account_without_metadata_is_cached_briefly_and_errors_are_not_cached(monkeypatch):
+    lookups = []
+
+    def missing():
+        lookups.append('missing')
+        return {}
+
+    def throttled():
+        lookups.append('throttled')
+        raise Exception('Rate exceeded')
+
+    monkeypatch.setitem(app.account_cache_settings, 'table', None)
+    for _ in range(2):
+        assert app.get_cached_account_metadata('222222222222', 'AlternateContact', missing) == {}
+    assert lookups == ['missing']
+    expires_at, metadata = app.account_cache.get(('222222222222', 'AlternateContact'))
+    assert expires_at <= app.time.time() + app.ACCOUNT_CACHE_NEGATIVE_TTL
+
+    for _ in range(2):
+        with pytest.raises(Exception, match='Rate exceeded'):
+            app.get_cached_account_metadata('333333333333', 'AlternateContact', throttled)
+    assert lookups == ['missing', 'throttled', 'throttled']
+
+
+def test_timed_out_account_lookups_keep_stored_values(monkeypatch):
+    table = InMemoryTable(0)
+    app.process_event(alarm_event('OK', '2024-01-01T00:00:00.000+0000', 'e1'), table, 1, math.inf)
+    stored_contact = stored_alarm(table)['auxiliaryInfo']['AlternateContact']
+    assert stored_contact['EmailAddress'] == 'ops@example.com'
+
+    def lookups_without_account(lookups, timeout):
+        return {name: lookup() for name, lookup in lookups.items() if name not in ('Account', 'AlternateContact')}
+
+    monkeypatch.setattr(app, 'run_lookups', lookups_without_account)
+    result = app.process_event(alarm_event('ALARM', '2024-01-01T00:01:00.000+0000', 'e2'), table, 1, math.inf)
+
+    assert result == 'Stored'
+    auxiliary_info = stored_alarm(table)['auxiliaryInfo']
+    assert auxiliary_info['AlternateContact'] == stored_contact
+    assert auxiliary_info['Account']['Email'] == 'account@example.com'
+
+
+def test_leaderboard_written_only_on_rank_changes(monkeypatch):
+    history_table = InMemoryTable(0, ('alarmKey', 'stateTimestamp'))
+    monkeypatch.setitem(app.history_settings, 'table', history_table)
+    monkeypatch.setitem(app.history_settings, 'leaderboardSize', 2)
+    monkeypatch.setattr(app, 'leaderboard_cache', {})
+    day = '2024-01-01'
+
+    for alarm_key, count in [('a', 1), ('b', 2), ('b', 3), ('b', 4), ('a', 2), ('a', 5), ('c', 4), ('c', 6)]:
+        app.update_leaderboard(day, alarm_key, count)
+
+    # a and b entered, a overtook b and c replaced b. Counts that didn't change the rank weren't written, c with 4
+    # didn't pass b although b is stored with 2
+    assert history_table.requests['PutItem'] == 4
+    leaderboard = history_table.items[('#leaderboard', day)]
+    assert leaderboard['top'] == {'a': 5, 'c': 6}
+
+
+def test_unchanged_and_stale_events_are_not_counted(monkeypatch):
+    history_table = InMemoryTable(0, ('alarmKey', 'stateTimestamp'))
+    monkeypatch.setitem(app.history_settings, 'table', history_table)
+    monkeypatch.setattr(app, 'leaderboard_cache', {})
+    table = InMemoryTable(0)
+
+    app.process_event(alarm_event('OK', '2024-01-01T00:00:00.000+0000', 'e1'), table, 1, math.inf)
+    app.process_event(alarm_event('OK', '2024-01-01T00:02:00.000+0000', 'e2'), table, 1, math.inf)
+    app.process_event(alarm_event('ALARM', '2024-01-01T00:01:00.000+0000', 'e3'), table, 1, math.inf)
+    app.process_event(alarm_event('ALARM', '2024-01-01T00:03:00.000+0000', 'e4'), table, 1, math.inf,
+                      coalesced=['2024-01-01T00:02:30.000+0000'])
+
+    counter = history_table.items[(f'{ACCOUNT_ID}#{ALARM_NAME}#{REGION}', '#count#2024-01-01')]
+    assert counter['transitions'] == 3
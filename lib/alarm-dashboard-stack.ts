@@ -1,11 +1,13 @@
 import * as cdk from 'aws-cdk-lib';
 import {Aws, CfnOutput, Duration, RemovalPolicy, Tags} from 'aws-cdk-lib';
 import {Construct} from 'constructs';
-import {EventBus, EventBusPolicy, Rule} from "aws-cdk-lib/aws-events";
+import {EventBus, EventBusPolicy, IRuleTarget, Rule, RuleTargetInput, Schedule} from "aws-cdk-lib/aws-events";
 import {Effect, PolicyStatement, Role, ServicePrincipal, StarPrincipal} from "aws-cdk-lib/aws-iam";
 import {AttributeType, BillingMode, ProjectionType, Table} from "aws-cdk-lib/aws-dynamodb";
-import {Architecture, Code, Function, Runtime, Tracing} from "aws-cdk-lib/aws-lambda";
-import {LambdaFunction} from 'aws-cdk-lib/aws-events-targets';
+import {Architecture, Code, Function, LayerVersion, Runtime, Tracing} from "aws-cdk-lib/aws-lambda";
+import {LambdaFunction, SqsQueue} from 'aws-cdk-lib/aws-events-targets';
+import {SqsEventSource} from "aws-cdk-lib/aws-lambda-event-sources";
+import {Queue, QueueEncryption} from "aws-cdk-lib/aws-sqs";
 import {StringParameter} from "aws-cdk-lib/aws-ssm";
 import {CustomWidget, Dashboard} from "aws-cdk-lib/aws-cloudwatch";
 import {NagSuppressions} from "cdk-nag";
@@ -89,9 +91,47 @@ export class AlarmDashboardStack extends cdk.Stack {
             sortKey: { name: 'suppressed', type: AttributeType.NUMBER},
             projectionType: ProjectionType.ALL
         });
+
+        // State transitions of the alarms, the history of one alarm is a query on alarmKey and
+        // all transitions of a time window are a query on DayIndex per day
+        const historyTable = new Table(this, 'AlarmHistoryDynamoDBTable', {
+            tableName: 'AlarmHistoryTableCDK',
+            partitionKey: { name: 'alarmKey', type: AttributeType.STRING },
+            sortKey: { name: 'stateTimestamp', type: AttributeType.STRING },
+            timeToLiveAttribute: 'expiresAt',
+            removalPolicy: RemovalPolicy.DESTROY,
+            billingMode: BillingMode.PAY_PER_REQUEST
+        });
+
+        historyTable.addGlobalSecondaryIndex({
+            indexName: 'DayIndex',
+            partitionKey: { name: 'day', type: AttributeType.STRING },
+            sortKey: { name: 'stateTimestamp', type: AttributeType.STRING },
+            projectionType: ProjectionType.ALL
+        });
+
+        parameterConfig['historyTableName'] = historyTable.tableName;
+        parameterConfig['historyRetentionDays'] = config.AlarmDashboard.historyRetentionDays?config.AlarmDashboard.historyRetentionDays:90;
+        // Filters and page of the alarm list per dashboard and widget
+        const viewStateTable = new Table(this, 'AlarmViewStateDynamoDBTable', {
+            tableName: 'AlarmViewStateTableCDK',
+            partitionKey: { name: 'viewKey', type: AttributeType.STRING },
+            removalPolicy: RemovalPolicy.DESTROY,
+            billingMode: BillingMode.PAY_PER_REQUEST
+        });
+
+        parameterConfig['viewStateTableName'] = viewStateTable.tableName;
+        parameterConfig['leaderboardSize'] = config.AlarmDashboard.leaderboardSize?config.AlarmDashboard.leaderboardSize:20;
         // END DynamoDB
 
 
+        // Configuration module shared by the Lambda functions (functions/common/python/alarm_config.py)
+        const alarmConfigLayer = new LayerVersion(this, 'AlarmConfigLayer', {
+            code: Code.fromAsset('functions/common'),
+            compatibleRuntimes: [Runtime.PYTHON_3_11],
+            description: 'Cached configuration of the alarm dashboard functions'
+        });
+
         //Lambda function for handling the events
         const ddbHandlerLambdaRole = new Role(this, 'CloudWatchAlarmDynamoDBHandlerExecutionRole',{
             description: 'CloudWatchAlarmDynamoDB Handler Role',
@@ -107,7 +147,8 @@ export class AlarmDashboardStack extends cdk.Stack {
             timeout: Duration.seconds(60),
             memorySize: 256,
             tracing: Tracing.ACTIVE,
-            role: ddbHandlerLambdaRole
+            role: ddbHandlerLambdaRole,
+            layers: [alarmConfigLayer]
         });
 
         //Adding policy to the lambda execution role
@@ -131,11 +172,28 @@ export class AlarmDashboardStack extends cdk.Stack {
                     'dynamodb:GetItem',
                     'dynamodb:UpdateItem',
                     'dynamodb:GetRecords',
+                    'dynamodb:BatchWriteItem',
+                    'dynamodb:BatchGetItem',
+                    'dynamodb:DeleteItem',
+                    'dynamodb:Scan',
                 ],
                 resources: [dynamoTable.tableArn],
             })
         );
 
+        ddbHandlerLambdaFunction.addToRolePolicy(
+            new PolicyStatement({
+                effect: Effect.ALLOW,
+                actions: [
+                    'dynamodb:PutItem',
+                    'dynamodb:GetItem',
+                    'dynamodb:UpdateItem',
+                    'dynamodb:BatchWriteItem',
+                ],
+                resources: [historyTable.tableArn],
+            })
+        );
+
         //Adding policy to the lambda execution role
         ddbHandlerLambdaFunction.addToRolePolicy(
             new PolicyStatement({
@@ -175,7 +233,8 @@ export class AlarmDashboardStack extends cdk.Stack {
             new PolicyStatement({
                 effect: Effect.ALLOW,
                 actions: [
-                    'cloudwatch:ListTagsForResource'
+                    'cloudwatch:ListTagsForResource',
+                    'cloudwatch:DescribeAlarms'
                 ],
                 resources: ['*']
             })
@@ -195,7 +254,8 @@ export class AlarmDashboardStack extends cdk.Stack {
             timeout: Duration.seconds(60),
             memorySize: 128,
             tracing: Tracing.ACTIVE,
-            role: configurationHandlerLambdaRole
+            role: configurationHandlerLambdaRole,
+            layers: [alarmConfigLayer]
         });
 
         configurationHandlerLambdaFunction.addToRolePolicy(
@@ -210,6 +270,7 @@ export class AlarmDashboardStack extends cdk.Stack {
             })
         );
 
+        // Suppressing an alarm updates its item
         configurationHandlerLambdaFunction.addToRolePolicy(
             new PolicyStatement({
                 effect: Effect.ALLOW,
@@ -220,8 +281,52 @@ export class AlarmDashboardStack extends cdk.Stack {
             })
         );
 
+        configurationHandlerLambdaFunction.addToRolePolicy(
+            new PolicyStatement({
+                effect: Effect.ALLOW,
+                actions: [
+                    'dynamodb:GetItem',
+                    'dynamodb:PutItem'
+                ],
+                resources: [viewStateTable.tableArn]
+            })
+        );
+
 
 
+        // Alarm events go to the Lambda function one by one or, with batch ingestion, through a queue in batches
+        let ddbHandlerTarget:IRuleTarget = new LambdaFunction(ddbHandlerLambdaFunction);
+        if (config.AlarmDashboard.batchIngestion == true) {
+            const alarmEventDeadLetterQueue = new Queue(this, 'AlarmEventDeadLetterQueue', {
+                encryption: QueueEncryption.SQS_MANAGED,
+                enforceSSL: true
+            });
+
+            const alarmEventQueue = new Queue(this, 'AlarmEventQueue', {
+                encryption: QueueEncryption.SQS_MANAGED,
+                enforceSSL: true,
+                visibilityTimeout: Duration.seconds(360),
+                deadLetterQueue: {
+                    queue: alarmEventDeadLetterQueue,
+                    maxReceiveCount: 5
+                }
+            });
+
+            ddbHandlerLambdaFunction.addEventSource(new SqsEventSource(alarmEventQueue, {
+                batchSize: 100,
+                maxBatchingWindow: Duration.seconds(5),
+                reportBatchItemFailures: true
+            }));
+            ddbHandlerTarget = new SqsQueue(alarmEventQueue);
+
+            NagSuppressions.addResourceSuppressions(alarmEventDeadLetterQueue,[
+                {
+                    id: 'AwsSolutions-SQS3',
+                    reason: 'This is the dead-letter queue of the alarm event queue'
+                }
+            ], true);
+        }
+
         // EventBus rule as Lambda function trigger (one on the custom eventbus and one on the default eventbus)
         new Rule(this, 'DDBHandlerTrigger', {
             eventBus: cloudwatchEventBus,
@@ -229,7 +334,7 @@ export class AlarmDashboardStack extends cdk.Stack {
                 source: ['aws.cloudwatch'],
                 detailType: ['CloudWatch Alarm State Change'],
             },
-            targets: [new LambdaFunction(ddbHandlerLambdaFunction)],
+            targets: [ddbHandlerTarget],
         });
 
         new Rule(this, 'LocalDDBHandlerTrigger', {
@@ -237,7 +342,33 @@ export class AlarmDashboardStack extends cdk.Stack {
                 source: ['aws.cloudwatch'],
                 detailType: ['CloudWatch Alarm State Change'],
             },
-            targets: [new LambdaFunction(ddbHandlerLambdaFunction)],
+            targets: [ddbHandlerTarget],
+        });
+
+        // Alarm tag changes refresh the cached alarm tags and priority
+        new Rule(this, 'DDBHandlerTagTrigger', {
+            eventBus: cloudwatchEventBus,
+            eventPattern: {
+                source: ['aws.tag'],
+                detailType: ['Tag Change on Resource'],
+                detail: {
+                    service: ['cloudwatch'],
+                    'resource-type': ['alarm']
+                }
+            },
+            targets: [ddbHandlerTarget],
+        });
+
+        new Rule(this, 'LocalDDBHandlerTagTrigger', {
+            eventPattern: {
+                source: ['aws.tag'],
+                detailType: ['Tag Change on Resource'],
+                detail: {
+                    service: ['cloudwatch'],
+                    'resource-type': ['alarm']
+                }
+            },
+            targets: [ddbHandlerTarget],
         });
 
 
@@ -247,6 +378,31 @@ export class AlarmDashboardStack extends cdk.Stack {
         parameterConfig['compact'] = 0
         parameterConfig['configuratorLambdaFunction'] = configurationHandlerLambdaFunction.functionArn;
         parameterConfig['alarmViewListSize'] = config.AlarmDashboard.alarmViewListSize?config.AlarmDashboard.alarmViewListSize:100;
+        parameterConfig['accountCacheTTL'] = config.AlarmDashboard.accountCacheTTL?config.AlarmDashboard.accountCacheTTL:86400;
+        parameterConfig['sharedAccountCache'] = config.AlarmDashboard.sharedAccountCache == true;
+        parameterConfig['enrichmentTimeout'] = config.AlarmDashboard.enrichmentTimeout?config.AlarmDashboard.enrichmentTimeout:10;
+        parameterConfig['compactSchema'] = config.AlarmDashboard.compactSchema != false;
+        parameterConfig['alarmTagCacheTTL'] = config.AlarmDashboard.alarmTagCacheTTL?config.AlarmDashboard.alarmTagCacheTTL:3600;
+        parameterConfig['flapThreshold'] = config.AlarmDashboard.flapThreshold?config.AlarmDashboard.flapThreshold:0;
+        parameterConfig['flapWindowSeconds'] = config.AlarmDashboard.flapWindowSeconds?config.AlarmDashboard.flapWindowSeconds:3600;
+
+        // Removes alarms deleted in the source accounts and flags alarms of deleted EC2 instances
+        new Rule(this, 'SweepTrigger', {
+            schedule: Schedule.rate(Duration.hours(config.AlarmDashboard.sweepIntervalHours?config.AlarmDashboard.sweepIntervalHours:6)),
+            targets: [new LambdaFunction(ddbHandlerLambdaFunction, {
+                event: RuleTargetInput.fromObject({sweep: true})
+            })],
+        });
+
+        if (config.AlarmDashboard.sharedAccountCache == true) {
+            // Refreshes the shared account cache for all accounts of the organization once a day
+            new Rule(this, 'WarmAccountCacheTrigger', {
+                schedule: Schedule.rate(Duration.days(1)),
+                targets: [new LambdaFunction(ddbHandlerLambdaFunction, {
+                    event: RuleTargetInput.fromObject({warmAccountCache: true})
+                })],
+            });
+        }
 
         const configParameter = new StringParameter(this, 'ConfigParameter', {
             stringValue: JSON.stringify(parameterConfig),
@@ -270,8 +426,7 @@ export class AlarmDashboardStack extends cdk.Stack {
             new PolicyStatement({
                 effect: Effect.ALLOW,
                 actions: [
-                    'ssm:GetParameter',
-                    'ssm:PutParameter'
+                    'ssm:GetParameter'
                 ],
                 resources: [`arn:aws:ssm:${Aws.REGION}:${Aws.ACCOUNT_ID}:parameter/CloudWatchAlarmWidgetConfigCDK`]
             })
@@ -288,7 +443,8 @@ export class AlarmDashboardStack extends cdk.Stack {
             handler: 'app.lambda_handler',
             runtime: Runtime.PYTHON_3_11,
             architecture: Architecture.X86_64,
-            role: alarmCWCustomFunctionRole
+            role: alarmCWCustomFunctionRole,
+            layers: [alarmConfigLayer]
         });
 
         alarmCWCustomFunction.addToRolePolicy(
@@ -343,7 +499,8 @@ export class AlarmDashboardStack extends cdk.Stack {
             runtime: Runtime.PYTHON_3_11,
             architecture: Architecture.X86_64,
             memorySize: 165,
-            role: alarmListCWCustomFunctionRole
+            role: alarmListCWCustomFunctionRole,
+            layers: [alarmConfigLayer]
         });
 
         alarmListCWCustomFunction.addToRolePolicy(
@@ -382,8 +539,30 @@ export class AlarmDashboardStack extends cdk.Stack {
             new PolicyStatement({
                 effect: Effect.ALLOW,
                 actions: [
-                    'ssm:GetParameter',
-                    'ssm:PutParameter'
+                    "dynamodb:GetItem",
+                    "dynamodb:PutItem"
+                ],
+                resources: [viewStateTable.tableArn],
+            })
+        );
+
+        // The noisiest alarms view reads the leaderboard item and the daily counters of its alarms
+        alarmListCWCustomFunction.addToRolePolicy(
+            new PolicyStatement({
+                effect: Effect.ALLOW,
+                actions: [
+                    "dynamodb:GetItem",
+                    "dynamodb:BatchGetItem"
+                ],
+                resources: [historyTable.tableArn],
+            })
+        );
+
+        alarmListCWCustomFunction.addToRolePolicy(
+            new PolicyStatement({
+                effect: Effect.ALLOW,
+                actions: [
+                    'ssm:GetParameter'
                 ],
                 resources: [configParameter.parameterArn],
             })
@@ -2,6 +2,7 @@ import {Stack,StackProps} from 'aws-cdk-lib';
 import {Construct} from 'constructs'
 import {GraphFactory} from "./services/graphfactory";
 import {Dashboard} from "aws-cdk-lib/aws-cloudwatch";
+import {MetricIndex} from "./services/metricindex";
 
 const config = require('./config.json');
 
@@ -21,7 +22,26 @@ export class IemDashboardStack extends Stack {
       console.log(`ERROR: ${config.ResourceFile} not found, run 'cd data; python resource_collector.py'`);
     }
 
-    const graphFactory = new GraphFactory(this,'GraphFactory',resources, config);
+    if (config.MetricIndexFile) {
+      try {
+        MetricIndex.load(require(config.MetricIndexFile));
+        console.log(`LOADED METRIC INDEX FILE ${config.MetricIndexFile}`);
+      } catch {
+        console.log(`${config.MetricIndexFile} not found, charting all metrics`);
+      }
+    }
+
+    let groupingIndex:any = undefined;
+    if (config.GroupingTagKey && config.GroupingIndexFile) {
+      try {
+        groupingIndex = require(config.GroupingIndexFile);
+        console.log(`LOADED GROUPING INDEX FILE ${config.GroupingIndexFile}`);
+      } catch {
+        console.log(`${config.GroupingIndexFile} not found, grouping resources by their tags`);
+      }
+    }
+
+    const graphFactory = new GraphFactory(this,'GraphFactory',resources, config, groupingIndex);
 
     for (let widget of graphFactory.getWidgets()){
       dashboard.addWidgets(widget);
@@ -47,10 +47,12 @@ export class GraphFactory extends Construct {
     alarmSet:any = [];
     config:any;
     groupResourcesByTag:boolean = false;
+    groupIndex:Map<string,string>|undefined;
 
-    constructor(scope: Construct, id: string, resources:any[], config:any){
+    constructor(scope: Construct, id: string, resources:any[], config:any, groupingIndex?:any){
         super(scope,id);
         this.config = config;
+        this.loadGroupingIndex(groupingIndex);
         this.sortARNsByService(resources);
         this.generate();
     }
@@ -694,33 +696,32 @@ export class GraphFactory extends Construct {
             let instance = new Ec2InstancesWidgetSet(this, `EC2InstancesWidgetSet-${instanceId}-${region}`,resource, this.config);
             if ( this.groupResourcesByTag ){
                 let instanceGrouped = false;
-                for ( const tag of resource.Tags ){
-                    if ( tag.Key === this.config.GroupingTagKey ){
-                        //Need to remove spaces from the tag value
-                        tag.Value = tag.Value.replace(/\s/g, '');
-                        if ( this.groupedDashboards.has(tag.Value) ){
-                            console.log(`Found Dashboard for value ${tag.Value}`);
-                        } else {
-                            console.log(`Creating Dashboard for value ${tag.Value}`);
-                            const tagLabelWidget = new TextWidget({
-                                markdown: `## EC2 Instances - ${tag.Value} ${region}`,
-                                width: 24,
-                                height: 1
-                            })
-                            let dash = new Dashboard(this,this.config.BaseName + '-EC2-Dashboard' + '-' + tag.Value,{
-                                dashboardName: this.config.BaseName + '-EC2-Dashboard' + '-' + tag.Value
-                            });
-                            this.estimatedCost += 3;
-                            dash.addWidgets(tagLabelWidget);
-                            this.groupedDashboards.set(tag.Value,dash);
-                        }
-                         //console.log(`adding instance grouped ${resource.Instance.InstanceId}`);
-                         for (const widget of instance.getWidgetSets()){
-                             this.groupedDashboards.get(tag.Value).addWidgets(widget);
-                         }
-                         this.alarmSet = this.alarmSet.concat(instance.getAlarmSet());
-                         instanceGrouped = true;
+                const groupValue = this.groupOf(resource);
+                if ( groupValue !== undefined ){
+                    //Need to remove spaces from the tag value
+                    const group = groupValue.replace(/\s/g, '');
+                    if ( this.groupedDashboards.has(group) ){
+                        console.log(`Found Dashboard for value ${group}`);
+                    } else {
+                        console.log(`Creating Dashboard for value ${group}`);
+                        const tagLabelWidget = new TextWidget({
+                            markdown: `## EC2 Instances - ${group} ${region}`,
+                            width: 24,
+                            height: 1
+                        })
+                        let dash = new Dashboard(this,this.config.BaseName + '-EC2-Dashboard' + '-' + group,{
+                            dashboardName: this.config.BaseName + '-EC2-Dashboard' + '-' + group
+                        });
+                        this.estimatedCost += 3;
+                        dash.addWidgets(tagLabelWidget);
+                        this.groupedDashboards.set(group,dash);
+                    }
+                    //console.log(`adding instance grouped ${resource.Instance.InstanceId}`);
+                    for (const widget of instance.getWidgetSets()){
+                        this.groupedDashboards.get(group).addWidgets(widget);
                     }
+                    this.alarmSet = this.alarmSet.concat(instance.getAlarmSet());
+                    instanceGrouped = true;
                 }
                 if ( ! instanceGrouped ){
                     if (!this.EC2Dashboard){
@@ -772,33 +773,29 @@ export class GraphFactory extends Construct {
             let lambdaGrouped = false;
             let targetDashboard: Dashboard | undefined;
 
-            if (this.groupResourcesByTag) {
-                for (const tag of resource.Tags) {
-                    if (tag.Key === this.config.GroupingTagKey) {
-                        tag.Value = tag.Value.replace(/\s/g, '');
+            const groupValue = this.groupResourcesByTag ? this.groupOf(resource) : undefined;
+            if (groupValue !== undefined) {
+                const group = groupValue.replace(/\s/g, '');
 
-                        if (this.groupedLambdaDashboards.has(tag.Value)) {
-                            console.log(`Found Lambda Dashboard for value ${tag.Value}`);
-                        } else {
-                            console.log(`Creating Lambda Dashboard for value ${tag.Value}`);
-                            const tagLabelWidget = new TextWidget({
-                                markdown: `## Lambdas - ${tag.Value} ${region}`,
-                                width: 24,
-                                height: 1
-                            });
-                            let dash = new Dashboard(this, this.config.BaseName + '-Lambda-Dashboard' + '-' + tag.Value, {
-                                dashboardName: this.config.BaseName + '-Lambda-Dashboard' + '-' + tag.Value
-                            });
-                            this.estimatedCost += 3;
-                            dash.addWidgets(tagLabelWidget);
-                            this.groupedLambdaDashboards.set(tag.Value, dash);
-                        }
-
-                        targetDashboard = this.groupedLambdaDashboards.get(tag.Value);
-                        lambdaGrouped = true;
-                        break;
-                    }
+                if (this.groupedLambdaDashboards.has(group)) {
+                    console.log(`Found Lambda Dashboard for value ${group}`);
+                } else {
+                    console.log(`Creating Lambda Dashboard for value ${group}`);
+                    const tagLabelWidget = new TextWidget({
+                        markdown: `## Lambdas - ${group} ${region}`,
+                        width: 24,
+                        height: 1
+                    });
+                    let dash = new Dashboard(this, this.config.BaseName + '-Lambda-Dashboard' + '-' + group, {
+                        dashboardName: this.config.BaseName + '-Lambda-Dashboard' + '-' + group
+                    });
+                    this.estimatedCost += 3;
+                    dash.addWidgets(tagLabelWidget);
+                    this.groupedLambdaDashboards.set(group, dash);
                 }
+
+                targetDashboard = this.groupedLambdaDashboards.get(group);
+                lambdaGrouped = true;
             }
 
             if (!lambdaGrouped) {
@@ -832,12 +829,7 @@ export class GraphFactory extends Construct {
             let groupName = 'default';
 
             if (this.groupResourcesByTag) {
-                for (const tag of resource.Tags) {
-                    if (tag.Key === this.config.GroupingTagKey) {
-                        groupName = tag.Value;
-                        break;
-                    }
-                }
+                groupName = this.groupOf(resource) ?? groupName;
             }
 
             if (!resourceGroups.has(groupName)) {
@@ -898,6 +890,39 @@ export class GraphFactory extends Construct {
         }
     }
 
+    /***
+     * Value of GroupingTagKey for a resource. Uses the grouping index written by resource_collector.py when it was
+     * generated for the same GroupingTagKey, otherwise falls back to scanning the tags of the resource. Resources
+     * missing from the index, for example when it is older than the resources file, are looked up in their tags too.
+     */
+    private groupOf(resource:any):string|undefined {
+        const indexedGroup = this.groupIndex?.get(resource.ResourceARN);
+        if (indexedGroup !== undefined) {
+            return indexedGroup;
+        }
+        for (const tag of resource.Tags ?? []) {
+            if (tag.Key === this.config.GroupingTagKey) {
+                return tag.Value;
+            }
+        }
+        return undefined;
+    }
+
+    private loadGroupingIndex(groupingIndex:any) {
+        if (!groupingIndex || groupingIndex.GroupingTagKey !== this.config.GroupingTagKey) {
+            return;
+        }
+        this.groupIndex = new Map<string,string>();
+        for (const group of Object.keys(groupingIndex.Groups)) {
+            for (const resourceType of Object.keys(groupingIndex.Groups[group])) {
+                for (const arn of groupingIndex.Groups[group][resourceType].Arns) {
+                    this.groupIndex.set(arn, group);
+                }
+            }
+        }
+        console.log(`Loaded grouping index with ${this.groupIndex.size} resources`);
+    }
+
     hasTagKey(data:any[],tagkey:string){
         for ( let item of data){
             if ( item.Key === tagkey ) return true
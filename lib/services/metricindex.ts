@@ -0,0 +1,44 @@
+import {Metric} from "aws-cdk-lib/aws-cloudwatch";
+
+/***
+ * Metric existence index generated by `data/resource_collector.py` (see `MetricIndexFile` in `lib/config.json`).
+ * Widget sets can use it to leave out metrics that aren't published for a resource. Regions missing from the index
+ * are treated as having every metric so dashboards look the same as without the index, and so are metrics the
+ * collector doesn't index (see INDEXED_METRICS in resource_collector.py).
+ */
+export class MetricIndex {
+    private static regions = new Map<string, Set<string>>();
+    private static indexedMetrics = new Map<string, Set<string>>();
+
+    static load(metricIndex:any) {
+        MetricIndex.regions.clear();
+        MetricIndex.indexedMetrics.clear();
+        for (const regionMetrics of metricIndex?.RegionMetrics ?? []) {
+            const keys = new Set<string>();
+            const names = new Set<string>();
+            for (const namespace of Object.keys(regionMetrics.Metrics)) {
+                for (const metricName of Object.keys(regionMetrics.Metrics[namespace])) {
+                    names.add(`${namespace}|${metricName}`);
+                    for (const dimensions of regionMetrics.Metrics[namespace][metricName]) {
+                        keys.add(`${namespace}|${metricName}|${dimensions}`);
+                    }
+                }
+            }
+            MetricIndex.regions.set(regionMetrics.Region, keys);
+            MetricIndex.indexedMetrics.set(regionMetrics.Region, names);
+        }
+    }
+
+    static has(region:string, namespace:string, metricName:string, dimensionsMap:any = {}):boolean {
+        const keys = MetricIndex.regions.get(region);
+        if (!keys || !MetricIndex.indexedMetrics.get(region)!.has(`${namespace}|${metricName}`)) {
+            return true;
+        }
+        const dimensions = Object.keys(dimensionsMap).sort().map(name => `${name}=${dimensionsMap[name]}`).join(',');
+        return keys.has(`${namespace}|${metricName}|${dimensions}`);
+    }
+
+    static filter(region:string, metrics:Metric[]):Metric[] {
+        return metrics.filter(metric => MetricIndex.has(region, metric.namespace, metric.metricName, metric.dimensions));
+    }
+}
@@ -10,6 +10,7 @@ import {
 } from "aws-cdk-lib/aws-cloudwatch";
 import {Duration} from "aws-cdk-lib";
 import {Construct} from "constructs";
+import {MetricIndex} from "../metricindex";
 
 export class ApiGatewayV1WidgetSet extends Construct implements WidgetSet{
     namespace:string = 'AWS/ApiGateway';
@@ -103,6 +104,31 @@ export class ApiGatewayV1WidgetSet extends Construct implements WidgetSet{
 
         this.alarmSet.push(error4xxAlarm,error5xxAlarm)
 
+        const hitMetric = new Metric({
+            namespace: this.namespace,
+            metricName: 'CacheHitCount',
+            dimensionsMap: {
+                ApiName: apigw
+            },
+            statistic: Statistic.SUM,
+            period: Duration.minutes(1)
+        });
+
+        const missMetric = new Metric({
+            namespace: this.namespace,
+            metricName: 'CacheMissCount',
+            dimensionsMap: {
+                ApiName: apigw
+            },
+            statistic: Statistic.SUM,
+            period: Duration.minutes(1)
+        });
+
+        // Cache metrics are only published for stages with caching enabled
+        if ( MetricIndex.filter(region, [hitMetric, missMetric]).length < 2 ){
+            hasCachingEnabled = false;
+        }
+
         const errors = new GraphWidget({
             title: 'Errors/Latency '+apigw,
             stacked: true,
@@ -129,26 +155,6 @@ export class ApiGatewayV1WidgetSet extends Construct implements WidgetSet{
         });
 
         if ( hasCachingEnabled ){
-            const hitMetric = new Metric({
-                namespace: this.namespace,
-                metricName: 'CacheHitCount',
-                dimensionsMap: {
-                    ApiName: apigw
-                },
-                statistic: Statistic.SUM,
-                period: Duration.minutes(1)
-            });
-
-            const missMetric = new Metric({
-                namespace: this.namespace,
-                metricName: 'CacheMissCount',
-                dimensionsMap: {
-                    ApiName: apigw
-                },
-                statistic: Statistic.SUM,
-                period: Duration.minutes(1)
-            });
-
             const missPercentage = new MathExpression({
                 expression: "(missMetric/hitMetric) * 100",
                 usingMetrics: {
@@ -3,6 +3,7 @@ import {WidgetSet} from "./widgetset";
 import {Duration} from "aws-cdk-lib";
 import {EbsWidgetSet} from "./ebs";
 import {Construct} from "constructs";
+import {MetricIndex} from "../metricindex";
 
 export class Ec2InstancesWidgetSet extends Construct implements WidgetSet{
     namespace:string='AWS/EC2';
@@ -296,45 +297,61 @@ export class Ec2InstancesWidgetSet extends Construct implements WidgetSet{
                 period: Duration.minutes(1)
             });
 
-            const memoryUsageCpuIoWaitWidget = new GraphWidget({
-                title: 'MemoryUsed Percent/CPU Iowait',
-                left:[memusedMetric],
-                right:[cpuIowaitMetric],
-                period: Duration.minutes(1),
-                region: region,
-                width: 12,
-                height: 5
-            });
+            // Widgets whose metrics are all missing from the metric index are left out
+            const agentWidgets = [];
+            const memusedMetrics = MetricIndex.filter(region, [memusedMetric]);
+            const cpuIowaitMetrics = MetricIndex.filter(region, [cpuIowaitMetric]);
+            if ( memusedMetrics.length + cpuIowaitMetrics.length > 0 ){
+                agentWidgets.push(new GraphWidget({
+                    title: 'MemoryUsed Percent/CPU Iowait',
+                    left:memusedMetrics,
+                    right:cpuIowaitMetrics,
+                    period: Duration.minutes(1),
+                    region: region,
+                    width: 12,
+                    height: 5
+                }));
+            }
 
-            const networkConnWidget = new GraphWidget({
-                title: 'TCP Established / TCP Time Wait',
-                left:[netstatEstablishedMetric],
-                right:[netstatTcpWaitMetric],
-                period: Duration.minutes(1),
-                region: region,
-                width: 6,
-                height: 5
-            });
+            const netstatEstablishedMetrics = MetricIndex.filter(region, [netstatEstablishedMetric]);
+            const netstatTcpWaitMetrics = MetricIndex.filter(region, [netstatTcpWaitMetric]);
+            if ( netstatEstablishedMetrics.length + netstatTcpWaitMetrics.length > 0 ){
+                agentWidgets.push(new GraphWidget({
+                    title: 'TCP Established / TCP Time Wait',
+                    left:netstatEstablishedMetrics,
+                    right:netstatTcpWaitMetrics,
+                    period: Duration.minutes(1),
+                    region: region,
+                    width: 6,
+                    height: 5
+                }));
+            }
 
-            const diskUtilWidget = new GraphWidget({
-                title: 'Disk used / Swap used percent',
-                left:[diskUsedPercentMetric],
-                right:[swapUsedPercentMetric],
-                period: Duration.minutes(1),
-                region: region,
-                width: 6,
-                height: 5,
-                leftYAxis:{
-                    min: 0,
-                    max: 100
-                },
-                rightYAxis:{
-                    min: 0,
-                    max: 100
-                }
-            });
+            const diskUsedPercentMetrics = MetricIndex.filter(region, [diskUsedPercentMetric]);
+            const swapUsedPercentMetrics = MetricIndex.filter(region, [swapUsedPercentMetric]);
+            if ( diskUsedPercentMetrics.length + swapUsedPercentMetrics.length > 0 ){
+                agentWidgets.push(new GraphWidget({
+                    title: 'Disk used / Swap used percent',
+                    left:diskUsedPercentMetrics,
+                    right:swapUsedPercentMetrics,
+                    period: Duration.minutes(1),
+                    region: region,
+                    width: 6,
+                    height: 5,
+                    leftYAxis:{
+                        min: 0,
+                        max: 100
+                    },
+                    rightYAxis:{
+                        min: 0,
+                        max: 100
+                    }
+                }));
+            }
 
-            this.widgetSet.push(new Row(memoryUsageCpuIoWaitWidget,networkConnWidget,diskUtilWidget));
+            if ( agentWidgets.length > 0 ){
+                this.widgetSet.push(new Row(...agentWidgets));
+            }
         }
 
         for (const volume of resource.Volumes) {